@@ -1,5 +1,5 @@
 from pytest import fixture
-from hypothesis import given
+from hypothesis import given, settings, HealthCheck
 from hypothesis.strategies import builds, text, lists
 
 from tripl import tripl
@@ -22,6 +22,570 @@ def triple_store():
     return tripl.TripleStore(schema=schema, default_cardinality='db.cardinality:one')
 
 
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
 @given(lists(builds(make_subject, id=text())))
 def test_issue14(triple_store, subjects):
     triple_store.assert_facts(subjects, id_attrs=['cft.subject:id'])
+
+
+def test_attr_descriptors_follow_schema(triple_store):
+    assert triple_store._attr('cft.seq:subject').card_one
+    assert triple_store._attr('cft.seq:_timepoint').reverse == 'cft.seq:timepoint'
+    assert triple_store._attr('cft.seq:_timepoint').ref
+    triple_store.assert_schema({'cft.subject:id': {'db:cardinality': 'db.cardinality:one'}})
+    assert triple_store._attr('cft.subject:id').card_one
+    triple_store.default_cardinality = 'db.cardinality:many'
+    assert not triple_store._attr('cft.seq:subject').card_one
+
+
+def test_value_index_match():
+    store = tripl.TripleStore(schema={'cft.subject:id': {'db:index': True}})
+    store.assert_facts([make_subject(id='QA255'), make_subject(id='QA344')])
+    assert store._attr('cft.subject:id').indexed
+    eid = tripl.some(store.match({'cft.subject:id': 'QA255'}))
+    assert store.entity(eid)['cft.subject:id'] == {'QA255'}
+    assert len(store.match({'cft.subject:id': ['QA255', 'QA344'], 'cft:type': 'cft.type:subject'})) == 2
+    assert store.index_stats()['ave'] > 0
+    # Turning the index on after the fact backfills it
+    store = tripl.TripleStore(facts=[make_subject(id='QA255')])
+    attr = store._codes.lookup('cft.subject:id')
+    assert not store._ave_index.get([attr])
+    store.assert_schema({'cft.subject:id': {'db:index': True}})
+    assert store._ave_index.get([attr, store._codes.lookup('QA255')])
+
+
+def test_unique_identity_upserts():
+    store = tripl.TripleStore(schema={'cft.subject:id': {'db:unique': 'db.unique:identity'}})
+    eid = store.assert_fact(make_subject(id='QA255'))
+    store.assert_facts([make_subject(id='QA255', name='first')])
+    store.assert_facts([{'cft.seq:id': 'seq1', 'cft.seq:subject': {'cft.subject:id': 'QA255'}}])
+    assert store.match({'cft.subject:id': 'QA255'}) == {eid}
+    assert store.entity(eid)['cft.subject:name'] == {'first'}
+    assert store.entity({'cft.seq:id': 'seq1'})['cft.seq:subject'][0].ident == eid
+
+
+def test_identity_conflicts_reported_in_bulk():
+    import warnings
+    store = tripl.TripleStore(schema={'cft.subject:id': {'db:unique': 'db.unique:identity'}})
+    store.assert_facts([{'db:ident': 'a', 'cft.subject:id': 'x'}, {'db:ident': 'b', 'cft.subject:id': 'y'}])
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        store.assert_facts([{'db:ident': 'c', 'cft.subject:id': 'x'}, {'db:ident': 'd', 'cft.subject:id': 'y'}])
+    conflict_warnings = [w.message for w in caught if isinstance(w.message, tripl.IdentityConflictWarning)]
+    assert len(conflict_warnings) == 1
+    assert len(conflict_warnings[0].conflicts) == 2
+
+
+def test_tuple_index_unboxes_and_prunes():
+    index = tripl.TupleIndex()
+    index.add(['e', 'a', 1])
+    assert index.keys == {'e': {'a': 1}}
+    index.add(['e', 'a', 2])
+    assert index.get(['e', 'a']) == {1, 2}
+    assert sorted(index) == [('e', 'a', 1), ('e', 'a', 2)]
+    index.remove(['e', 'a', 1])
+    assert index.keys == {'e': {'a': 2}}
+    assert index.contains(['e', 'a', 2]) and not index.contains(['e', 'a', 1])
+    index.remove(['e', 'a', 2])
+    assert index.keys == {}
+
+
+def test_cardinality_one_overwrites(triple_store):
+    eid = triple_store.assert_fact({'cft.seq:id': 'seq1', 'cft.seq:subject': 'subject1'})
+    triple_store.assert_fact({'db:ident': eid, 'cft.seq:subject': 'subject2'})
+    assert triple_store.pull(['cft.seq:subject'], eid) == {'cft.seq:subject': 'subject2'}
+    assert not triple_store.match({'cft.seq:subject': 'subject1'})
+
+
+def test_dictionary_encoding_round_trip(tmpdir):
+    store = tripl.TripleStore(facts=[{'db:ident': 'a', 'x:n': 1, 'x:flag': True, 'x:name': 'one'}])
+    assert store.match({'x:n': 1}) == {'a'}
+    assert store.match({'x:flag': True}) == {'a'}
+    assert all(isinstance(code, int) for code in store._eav_index.keys)
+    filename = str(tmpdir.join('store.json'))
+    store.dump(filename)
+    reloaded = tripl.TripleStore.load(filename)
+    assert reloaded.pull(['x:n', 'x:name'], 'a') == {'x:n': {1}, 'x:name': {'one'}}
+
+
+def test_bulk_assert_matches_sequential():
+    facts = [make_subject(id='QA255'),
+             {'cft.seq:id': 'seq1', 'cft.seq:subject': {'cft.subject:id': 'QA255'},
+              'cft.seq:timepoint': [{'cft.timepoint:id': 'tp1'}, {'cft.timepoint:id': 'tp2'}]},
+             {'cft.seq:id': 'seq2', 'cft.seq:subject': {'cft.subject:id': 'QA255'},
+              'cft.seq:timepoint': [{'cft.timepoint:id': 'tp1'}]}]
+    id_attrs = ['cft.subject:id', 'cft.timepoint:id', 'cft.seq:id']
+    sequential = tripl.TripleStore(schema=schema, default_cardinality='db.cardinality:one')
+    sequential.assert_facts(facts, id_attrs=id_attrs)
+    bulk = tripl.TripleStore(schema=schema, default_cardinality='db.cardinality:one')
+    with bulk.transaction(id_attrs=id_attrs) as tx:
+        tx.assert_facts(facts)
+    assert tx.report['entities'] == 8
+    assert tx.report['new_entities'] == 5
+    assert len(tx.report['eids']) == 3
+
+    pull_expr = ['cft.seq:id', {'cft.seq:subject': ['cft.subject:id'], 'cft.seq:timepoint': ['cft.timepoint:id']}]
+    def pulled(store):
+        return sorted(str(store.pull(pull_expr, eid)) for eid in store.match({'cft.seq:id': ['seq1', 'seq2']}))
+    assert pulled(bulk) == pulled(sequential)
+    # cardinality one overwrites in bulk too
+    seq1 = tx.report['eids'][1]
+    report = bulk.assert_facts([{'db:ident': seq1, 'cft.seq:subject': {'cft.subject:id': 'QA344'}}], bulk=True)
+    assert report['retracted'] == 1
+    assert bulk.match({'cft.seq:subject': {'cft.subject:id': 'QA344'}}) == {seq1}
+    # entities already in the store are found through id_attrs
+    report = bulk.assert_facts([{'cft.seq:id': 'seq2', 'cft.seq:count': 2}, {'cft.seq:id': 'seq3'}],
+                               id_attrs=id_attrs, bulk=True)
+    assert report['new_entities'] == 1 and report['eids'][0] == tx.report['eids'][2]
+
+
+def test_streaming_load(tmpdir):
+    import io
+    import json
+    facts = [make_subject(id='QA{}'.format(i), count=i * 1000) for i in range(20)]
+    raw = json.dumps(facts).encode('utf-8')
+    progress = []
+    streamed = list(tripl.iter_json_facts(io.BytesIO(raw), chunk_size=7,
+                                          progress=lambda n, size: progress.append(size)))
+    assert streamed == facts
+    assert progress[-1] == len(raw)
+    # EAV index files stream as triples, entity by entity
+    store = tripl.TripleStore(facts=facts)
+    filename = str(tmpdir.join('store.json'))
+    store.dump(filename)
+    reloaded = tripl.TripleStore.load(filename)
+    assert sorted(reloaded.triples()) == sorted(store.triples())
+
+
+def test_parallel_loads_merge_identities(tmpdir):
+    import json
+    filenames = []
+    for i in range(4):
+        # every file mentions QA0 and a couple of its own subjects
+        facts = [make_subject(id='QA0', count=i)] + [make_subject(id='QA{}{}'.format(i, j), count=j) for j in range(2)]
+        filename = str(tmpdir.join('facts{}.json'.format(i)))
+        with open(filename, 'w') as fh:
+            json.dump(facts, fh)
+        filenames.append(filename)
+    sequential = tripl.TripleStore.loads(filenames, id_attrs=['cft.subject:id'])
+    parallel = tripl.TripleStore.loads(filenames, id_attrs=['cft.subject:id'], processes=2)
+    pull_expr = ['cft.subject:id', 'cft.subject:count']
+    by_id = lambda store: sorted((tripl.some(e['cft.subject:id']), sorted(e['cft.subject:count']))
+                                 for e in store.pull_many(pull_expr, {'cft:type': 'cft.type:subject'}))
+    assert by_id(parallel) == by_id(sequential)
+    assert len(by_id(parallel)) == 9
+    assert len(parallel.match({'cft.subject:id': 'QA0'})) == 1
+
+
+def test_cli_map_command_ingest(tmpdir):
+    import argparse
+    import json
+    import pytest
+    from tripl import cli
+    inputs = []
+    for i in range(5):
+        filename = str(tmpdir.join('facts{}.json'.format(i)))
+        with open(filename, 'w') as fh:
+            json.dump([make_subject(id='QA{}'.format(i))], fh)
+        inputs.append(filename)
+    args = argparse.Namespace(map_command='cat', inputs=inputs, processes=2, id_attrs=['cft.subject:id'])
+    store = cli.ingest(args)
+    assert len(store.match({'cft:type': 'cft.type:subject'})) == 5
+    # a bad input is reported by name, after the rest are ingested
+    args.inputs = inputs + [str(tmpdir.join('missing.json'))]
+    with pytest.raises(cli.IngestError) as excinfo:
+        cli.ingest(args)
+    assert [path for path, _ in excinfo.value.failures] == [args.inputs[-1]]
+    # as is one that blows up some other way, rather than leaving ingest waiting on it
+    deep = str(tmpdir.join('deep.json'))
+    with open(deep, 'w') as fh:
+        fh.write('[' * 100000 + ']' * 100000)
+    args.inputs = inputs + [deep]
+    with pytest.raises(cli.IngestError) as excinfo:
+        cli.ingest(args)
+    assert [path for path, _ in excinfo.value.failures] == [deep]
+
+
+def test_snapshot_round_trip(tmpdir):
+    store = tripl.TripleStore(schema=schema, facts=[make_subject(id='QA255'),
+                                                    {'cft.seq:id': 'seq1', 'cft.seq:subject': {'cft.subject:id': 'QA255'}}],
+                              id_attrs=['cft.subject:id'])
+    filename = str(tmpdir.join('store.snapshot'))
+    store.dump(filename, format='snapshot')
+    reloaded = tripl.TripleStore.load(filename)
+    assert sorted(map(str, reloaded.triples())) == sorted(map(str, store.triples()))
+    seq = reloaded.entity({'cft.seq:id': 'seq1'})
+    assert seq['cft.seq:subject'][0]['cft.subject:id'] == {'QA255'}
+    # unique identity survives, so new facts still resolve to the same entity
+    reloaded.assert_facts([make_subject(id='QA255', name='first')])
+    assert len(reloaded.match({'cft:type': 'cft.type:subject'})) == 1
+
+
+def test_cli_loads_snapshots_in_parallel(tmpdir):
+    import argparse
+    from tripl import cli
+    inputs = []
+    for i in range(3):
+        filename = str(tmpdir.join('f{}.snap'.format(i)))
+        tripl.TripleStore(facts=[make_subject(id='QA0', count=i), make_subject(id='QA{}'.format(i + 1))],
+                          id_attrs=['cft.subject:id']).dump(filename, format='snapshot')
+        inputs.append(filename)
+    args = argparse.Namespace(map_command=None, inputs=inputs, processes=2, id_attrs=['cft.subject:id'])
+    store = cli.ingest(args)
+    assert len(store.match({'cft:type': 'cft.type:subject'})) == 4
+    assert sorted(store.entity({'cft.subject:id': 'QA0'})['cft.subject:count']) == [0, 1, 2]
+
+
+def test_columnar_store_matches_in_memory(tmpdir):
+    import pytest
+    from tripl import columnar
+    store = tripl.TripleStore(schema=schema, default_cardinality='db.cardinality:one')
+    store.assert_facts([{'cft.seq:id': 'seq{}'.format(i), 'cft.seq:count': i, 'cft.seq:flag': i % 2 == 0,
+                         'cft.seq:subject': {'cft.subject:id': 'QA{}'.format(i % 2)},
+                         'cft.seq:timepoint': [{'cft.timepoint:id': 'tp1'}, {'cft.timepoint:id': 'tp2'}]}
+                        for i in range(4)], id_attrs=['cft.subject:id', 'cft.timepoint:id'])
+    filename = str(tmpdir.join('store.columnar'))
+    store.dump(filename, format='columnar')
+    mapped = columnar.MappedTripleStore(filename)
+    assert sorted(map(str, mapped.triples())) == sorted(map(str, store.triples()))
+    for pattern in [{'cft.seq:count': 2}, {'cft.seq:flag': True}, {'cft.seq:subject': {'cft.subject:id': 'QA1'}}]:
+        assert mapped.match(pattern) == store.match(pattern)
+    pull_expr = ['cft.seq:id', {'cft.seq:subject': ['*', {'cft.seq:_subject': ['cft.seq:id']}]}]
+    eid = tripl.some(store.match({'cft.seq:id': 'seq1'}))
+    assert mapped.pull(pull_expr, eid) == store.pull(pull_expr, eid)
+    entity = mapped.entity({'cft.seq:id': 'seq3'})
+    assert entity['cft.seq:count'] == {3} and 'cft.seq:flag' in entity
+    assert sorted(tp.some('cft.timepoint:id') for tp in entity['cft.seq:timepoint']) == ['tp1', 'tp2']
+    assert mapped.match({'cft.seq:id': 'nope'}) == set()
+    # dumps back out as columnar, but can't be snapshotted
+    again = str(tmpdir.join('again.columnar'))
+    mapped.dump(again, format='columnar')
+    assert sorted(map(str, columnar.MappedTripleStore(again).triples())) == sorted(map(str, store.triples()))
+    with pytest.raises(TypeError):
+        mapped.dump(str(tmpdir.join('store.snapshot')), format='snapshot')
+
+
+def test_match_plans_cheapest_clause_first():
+    store = tripl.TripleStore(schema=dict(schema, **{'cft.seq:id': {'db:index': True}}))
+    store.assert_facts([{'cft.seq:id': 'seq{}'.format(i), 'cft:type': 'cft.type:seq',
+                         'cft.seq:subject': {'cft.subject:id': 'QA{}'.format(i % 3)}} for i in range(30)])
+    plan = store._plan_match({'cft:type': 'cft.type:seq', 'cft.seq:id': 'seq7'})
+    assert [attr for attr, _ in plan] == ['cft.seq:id', 'cft:type']
+    assert len(store.match({'cft:type': 'cft.type:seq', 'cft.seq:id': 'seq7'})) == 1
+    # nested patterns are only probed against the candidates' refs
+    assert len(store.match({'cft.seq:id': ['seq1', 'seq2'], 'cft.seq:subject': {'cft.subject:id': 'QA1'}})) == 1
+    assert len(store.match({'cft.seq:subject': {'cft.subject:id': 'QA1'}})) == 10
+    assert store.match({'cft:type': 'cft.type:seq', 'cft.seq:id': 'nope'}) == set()
+    # values that were never asserted match nothing, without scanning for them
+    aev, store._aev_index = store._aev_index, None
+    assert store.match({'cft:type': 'never-seen'}) == set()
+    assert store.match({'cft.seq:subject': {'cft.subject:id': 'never-seen'}}) == set()
+    store._aev_index = aev
+
+
+def test_datalog_queries():
+    store = tripl.TripleStore(schema={'person:parent': {'db:valueType': 'db.type:ref'},
+                                      'person:name': {'db:cardinality': 'db.cardinality:one'}})
+    names = ['ann', 'bob', 'cat', 'dan', 'eve']
+    for i, name in enumerate(names):
+        fact = {'db:ident': name, 'person:name': name, 'person:age': 100 - 20 * i}
+        if i:
+            # each person's parent is the previous one
+            fact['person:parent'] = names[i - 1]
+        store.assert_fact(fact)
+    assert store.q({'find': ['?name'],
+                    'where': [['?x', 'person:parent', '?y'], ['?y', 'person:name', 'cat'],
+                              ['?x', 'person:name', '?name']]}) == [('dan',)]
+    grandparents = store.q({'find': ['?x', '?z'],
+                            'where': [['?x', 'person:parent', '?y'], ['?y', 'person:parent', '?z']],
+                            'sort': '?x'})
+    assert grandparents == [('cat', 'ann'), ('dan', 'bob'), ('eve', 'cat')]
+    ancestors = {'find': ['?a'],
+                 'where': [['ancestor', 'eve', '?a']],
+                 'rules': [[['ancestor', '?x', '?y'], ['?x', 'person:parent', '?y']],
+                           [['ancestor', '?x', '?z'], ['?x', 'person:parent', '?y'], ['ancestor', '?y', '?z']]]}
+    assert sorted(store.q(ancestors)) == [('ann',), ('bob',), ('cat',), ('dan',)]
+    oldest = store.q({'find': ['?name', '?age'],
+                      'where': [['?x', 'person:name', '?name'], ['?x', 'person:age', '?age']],
+                      'sort': '?age', 'sort_desc': True, 'take': 2})
+    assert oldest == [('ann', 100), ('bob', 80)]
+    assert len(store.q({'find': ['?x'], 'where': [['?x', 'person:name', '?n']], 'take': 3})) == 3
+    assert store.q({'find': ['?x'], 'where': [['?x', 'person:name', 'nobody']]}) == []
+
+
+def test_recursive_pull_and_rules():
+    store = tripl.TripleStore(schema={'person:parent': {'db:valueType': 'db.type:ref',
+                                                        'db:cardinality': 'db.cardinality:one'}})
+    depth = 3000
+    # a lineage deeper than the recursion limit would allow pulling one level at a time
+    store.assert_facts([{'db:ident': 'p{}'.format(i), 'person:n': i, 'person:parent': 'p{}'.format(i + 1)}
+                        for i in range(depth)])
+    result = store.pull(['person:n', {'person:parent': '...'}], 'p0')
+    for i in range(depth):
+        assert result['person:n'] == {i}
+        result = result['person:parent']
+    assert result == {'person:n': None, 'person:parent': None}
+    # cycles terminate, with the entity closing the loop pulled as just its ident
+    store.assert_fact({'db:ident': 'p{}'.format(depth), 'person:parent': 'p0'})
+    result = store.pull(['person:n', {'person:parent': '...'}], 'p{}'.format(depth - 1))
+    for _ in range(depth + 1):
+        result = result['person:parent']
+    assert result == {'db:ident': {'p{}'.format(depth - 1)}}
+    # closures are only memoized for the length of a query, so the next one sees any changes
+    anc = {'find': ['?a'], 'where': [['anc', 'p2990', '?a'], ['?a', 'person:n', '?n']],
+           'rules': [[['anc', '?x', '?y'], ['?x', 'person:parent', '?y']],
+                     [['anc', '?x', '?z'], ['?x', 'person:parent', '?y'], ['anc', '?y', '?z']]]}
+    assert len(store.q(anc)) == depth
+    store.assert_fact({'db:ident': 'p{}'.format(depth), 'person:parent': 'p2995'})
+    assert len(store.q(anc)) == 9
+    # rules that aren't plain closures are evaluated semi-naively
+    store = tripl.TripleStore(facts=[{'db:ident': 'p{}'.format(i), 'person:parent': 'p{}'.format(i + 1)}
+                                     for i in range(20)])
+    hops = store.q({'find': ['?y'], 'where': [['two-hop', 'p0', '?y']],
+                    'rules': [[['two-hop', '?x', '?z'], ['?x', 'person:parent', '?y'], ['?y', 'person:parent', '?z']],
+                              [['two-hop', '?x', '?z'], ['two-hop', '?x', '?y'], ['two-hop', '?y', '?z']]]})
+    assert sorted(hops) == sorted(('p{}'.format(i),) for i in range(2, 21, 2))
+
+
+def test_compiled_pull_plans(triple_store):
+    triple_store.assert_facts([{'cft.seq:id': 'seq{}'.format(i), 'cft.seq:subject': {'cft.subject:id': 'QA255'}}
+                               for i in range(3)], id_attrs=['cft.subject:id'])
+    subject = tripl.some(triple_store.match({'cft.subject:id': 'QA255'}))
+    # wildcards and attribute level reverse lookups both come through
+    result = triple_store.pull(['*', 'cft.seq:_subject'], subject)
+    assert result['cft.subject:id'] == {'QA255'}
+    assert len(result['cft.seq:_subject']) == 3
+    assert all(set(x) == {'db:ident'} for x in result['cft.seq:_subject'])
+    plan = triple_store.compile_pull(['cft.seq:id', {'cft.seq:subject': ['cft.subject:id']}])
+    assert triple_store.compile_pull(plan) is plan
+    pulled = list(triple_store.pull_many(plan, {'cft.seq:subject': {'cft.subject:id': 'QA255'}}))
+    assert sorted(tripl.some(x['cft.seq:id']) for x in pulled) == ['seq0', 'seq1', 'seq2']
+    assert all(x['cft.seq:subject'] == {'cft.subject:id': {'QA255'}} for x in pulled)
+
+
+def test_parallel_pull_many():
+    store = tripl.TripleStore(facts=[{'db:ident': 'e{}'.format(i), 'x:n': i} for i in range(50)])
+    eids = ['e{}'.format(i) for i in range(50)]
+    serial = list(store.pull_many(['x:n'], eids))
+    assert list(store.pull_many(['x:n'], eids, workers=2, chunk_size=7)) == serial
+    unordered = store.pull_many(['x:n'], eids, workers=2, ordered=False, chunk_size=7)
+    assert sorted(tripl.some(x['x:n']) for x in unordered) == list(range(50))
+
+
+def test_cli_streams_pulled_results():
+    import io
+    import json
+    from tripl import cli
+    store = tripl.TripleStore(facts=[{'db:ident': 'e{}'.format(i), 'x:n': i} for i in range(5)])
+    for format, parse in [('json', json.loads),
+                          ('ndjson', lambda text: [json.loads(line) for line in text.splitlines()])]:
+        fh = io.StringIO()
+        cli.write_pulled(store.pull_many(['x:n'], ['e{}'.format(i) for i in range(5)]), fh, format=format,
+                         chunk_size=2)
+        assert parse(fh.getvalue()) == [{'x:n': [i]} for i in range(5)]
+        fh = io.StringIO()
+        cli.write_pulled([], fh, format=format)
+        assert parse(fh.getvalue()) == []
+
+
+def test_pull_memoizes_shared_subdocuments(triple_store):
+    triple_store.assert_facts([{'cft.seq:id': 'seq{}'.format(i), 'cft.seq:subject': {'cft.subject:id': 'QA255'}}
+                               for i in range(3)], id_attrs=['cft.subject:id'])
+    pulled = list(triple_store.pull_many(['cft.seq:id', {'cft.seq:subject': ['*']}],
+                                         {'cft.seq:subject': {'cft.subject:id': 'QA255'}}))
+    assert pulled[0]['cft.seq:subject'] is pulled[1]['cft.seq:subject']
+    # across calls, until something they depend on is written
+    plan = triple_store.compile_pull(['cft.seq:id', {'cft.seq:subject': ['cft.subject:name']}], memoize=True)
+    seq = tripl.some(triple_store.match({'cft.seq:id': 'seq0'}))
+    first = triple_store.pull(plan, seq)['cft.seq:subject']
+    assert triple_store.pull(plan, seq)['cft.seq:subject'] is first
+    triple_store.assert_facts([{'cft.subject:id': 'QA255', 'cft.subject:name': 'first'}],
+                              id_attrs=['cft.subject:id'])
+    assert triple_store.pull(plan, seq)['cft.seq:subject'] == {'cft.subject:name': {'first'}}
+
+
+def test_pull_memo_skips_recursion_stubs():
+    ref = {'db:valueType': 'db.type:ref', 'db:cardinality': 'db.cardinality:one'}
+    store = tripl.TripleStore(schema={attr: ref for attr in ['a:link', 'a:next', 'a:friend', 'a:pal']})
+    store.assert_facts([{'db:ident': 'x', 'a:n': 1, 'a:next': 'm'}, {'db:ident': 'm', 'a:link': 'z'},
+                        {'db:ident': 'z', 'a:friend': 'w'}, {'db:ident': 'w', 'a:pal': 'x'},
+                        {'db:ident': 'r', 'a:link': 'x'}, {'db:ident': 'q', 'a:link': 'z'}])
+    expr = [{'a:link': ['a:n', {'a:next': '...', 'a:friend': ['a:n', {'a:pal': ['a:n']}]}]}]
+    # w is first pulled while recursing through x (so x is a stub there), then again directly from q
+    direct = store.pull(expr, 'q')
+    assert direct['a:link']['a:friend']['a:pal'] == {'a:n': {1}}
+    assert list(store.pull_many(expr, ['r', 'q']))[1] == direct
+
+
+def test_match_cache_invalidated_per_attribute():
+    store = tripl.TripleStore(facts=[make_subject(id='QA{}'.format(i)) for i in range(3)], match_cache_size=2)
+    assert len(store.match({'cft:type': 'cft.type:subject'})) == 3
+    assert len(store.match({'cft:type': ['cft.type:subject']})) == 3
+    assert store.match_cache_stats()['hits'] == 1
+    # writing some other attribute leaves it be
+    store.assert_fact({'db:ident': 'x', 'other:attr': 1})
+    store.match({'cft:type': 'cft.type:subject'})
+    assert store.match_cache_stats()['hits'] == 2
+    store.assert_fact(make_subject(id='QA3'))
+    assert len(store.match({'cft:type': 'cft.type:subject'})) == 4
+    assert store.match_cache_stats()['invalidations'] == 1
+    for i in range(3):
+        store.match({'cft.subject:id': 'QA{}'.format(i)})
+    stats = store.match_cache_stats()
+    assert stats['size'] == 2 and stats['evictions'] == 2
+
+
+def test_entities_are_identity_mapped(triple_store):
+    triple_store.assert_facts([{'cft.seq:id': 'seq{}'.format(i), 'cft.seq:subject': {'cft.subject:id': 'QA255'}}
+                               for i in range(3)], id_attrs=['cft.subject:id'])
+    seqs = triple_store.entities({'cft.seq:subject': {'cft.subject:id': 'QA255'}})
+    subjects = [seq['cft.seq:subject'] for seq in seqs]
+    assert subjects[0] is subjects[1] is subjects[2]
+    assert triple_store.entity(subjects[0].ident) is subjects[0]
+    assert not hasattr(subjects[0], '__dict__')
+    # entities read through to the store
+    assert subjects[0].namespace is None
+    triple_store.assert_fact({'db:ident': subjects[0].ident, 'tripl:type': 'cft.subject'})
+    assert subjects[0].namespace == 'cft.subject'
+    assert subjects[0].id == {'QA255'}
+    # including once there's nothing left of them
+    triple_store.retract_entity(subjects[0].ident)
+    assert subjects[0]['cft.subject:id'] is None and 'cft.subject:id' not in subjects[0]
+    assert len(subjects[0]) == 0 and subjects[0].keys() == []
+    assert len(tripl.Entity(triple_store, 'never-asserted')) == 0
+
+
+def test_lazy_ref_reverse_lookups_indexed_on_demand():
+    store = tripl.TripleStore(facts=[{'db:ident': 'p{}'.format(i), 'person:parent': 'p0'} for i in range(1, 4)])
+    parent = store._codes.lookup('person:parent')
+    assert not store._ave_index.get([parent])
+    children = store.entity('p0')['person:_parent']
+    assert sorted(child.ident for child in children) == ['p1', 'p2', 'p3']
+    assert store._attr('person:parent').indexed
+    # and kept up to date from then on
+    store.assert_fact({'db:ident': 'p4', 'person:parent': 'p0'})
+    pulled = store.pull(['person:_parent'], 'p0')['person:_parent']
+    assert sorted(tripl.some(x['db:ident']) for x in pulled) == ['p1', 'p2', 'p3', 'p4']
+
+
+def test_lazy_ref_classification_per_attribute():
+    store = tripl.TripleStore(facts=[{'db:ident': 'a', 'x:friend': 'b', 'x:name': 'ann'},
+                                     {'db:ident': 'b', 'x:friend': 'a', 'x:name': 'bob'}])
+    assert store.entity('a')['x:friend'][0] is store.entity('b')
+    assert store.entity('a')['x:name'] == {'ann'}
+    friend, name = store._codes.lookup('x:friend'), store._codes.lookup('x:name')
+    assert store._ref_classes == {friend: 'ref', name: 'plain'}
+    # a value that isn't an entity makes it a mix, checked value by value
+    store.assert_fact({'db:ident': 'b', 'x:friend': 'nobody'})
+    assert store._ref_classes[friend] == 'mixed'
+    assert store.entity('a')['x:friend'][0].ident == 'b'
+    assert store.entity('b')['x:friend'] == {'a', 'nobody'}
+    # until it is one
+    store.assert_fact({'db:ident': 'nobody', 'x:name': 'ned'})
+    assert len(store.entity('b')['x:friend']) == 2
+    # (x:name can't be checked for it without a scan, so is classified again on the next read)
+    assert store.entity('a')['x:name'] == {'ann'}
+    # entities that can't be anyone's value yet leave the classes be
+    store.assert_fact({'db:ident': 'c', 'x:name': 'cat'})
+    assert store._ref_classes == {friend: 'mixed', name: 'plain'}
+    # while a value that turns into an entity reclassifies whatever it's a value of
+    store.assert_fact({'db:ident': 'cat', 'x:friend': 'a'})
+    assert store.entity('c')['x:name'][0].ident == 'cat'
+    assert store._ref_classes[name] == 'mixed'
+
+
+def test_write_ahead_log_replay_and_compaction(tmpdir):
+    import os
+    import pytest
+    filename = str(tmpdir.join('store.snapshot'))
+    store = tripl.TripleStore.open(filename, schema=schema, default_cardinality='db.cardinality:one')
+    store.assert_facts([make_subject(id='QA255')], id_attrs=['cft.subject:id'])
+    eid = store.assert_fact({'cft.seq:id': 'seq1', 'cft.seq:subject': 'subject1'})
+    store.assert_fact({'db:ident': eid, 'cft.seq:subject': 'subject2'})
+    # crash, leaving half a record at the end of the log
+    with open(filename + '.log', 'ab') as fh:
+        fh.write(b'\x40\0\0\0garbage')
+    reopened = tripl.TripleStore.open(filename)
+    assert sorted(map(str, reopened.triples())) == sorted(map(str, store.triples()))
+    assert reopened.pull(['cft.seq:subject'], eid) == {'cft.seq:subject': 'subject2'}
+    reopened.assert_fact({'db:ident': eid, 'cft.seq:count': 3})
+    size = os.path.getsize(filename + '.log')
+    reopened.compact()
+    assert os.path.getsize(filename + '.log') < size
+    reopened.close()
+    final = tripl.TripleStore.open(filename)
+    assert final.entity(eid)['cft.seq:count'] == {3}
+    assert sorted(map(str, final.triples())) == sorted(map(str, reopened.triples()))
+    for s in (store, final):
+        s.close()
+    # settings passed when reopening apply, and stick
+    store = tripl.TripleStore.open(filename, match_cache_size=10, default_cardinality='db.cardinality:many',
+                                   schema={'cft.seq:id': {'db:index': True}})
+    assert store.match_cache_stats()['capacity'] == 10
+    assert store.default_cardinality == 'db.cardinality:many'
+    store.close()
+    store = tripl.TripleStore.open(filename)
+    assert store.default_cardinality == 'db.cardinality:many' and store._attr('cft.seq:id').indexed
+    store.close()
+    with pytest.raises(ValueError):
+        tripl.TripleStore.open(filename, facts=[make_subject(id='QA344')])
+    # including turning lazy refs off
+    assert not tripl.TripleStore(lazy_refs=False).lazy_refs
+    tripl.TripleStore.open(filename, lazy_refs=False).close()
+    store = tripl.TripleStore.open(filename)
+    assert store.lazy_refs is False and store.pull(['*'], 'db:schema')['db.refs:lazy'] is False
+    store.close()
+    # and stores that weren't opened have the same logging state, with nothing to log to
+    assert tripl.TripleStore()._snapshot_path is None
+
+
+def test_retraction_cleans_up_indexes():
+    store = tripl.TripleStore(schema={'person:parent': {'db:valueType': 'db.type:ref'},
+                                      'person:name': {'db:index': True}}, match_cache_size=10)
+    store.assert_facts([{'db:ident': 'ann', 'person:name': 'ann', 'person:tag': ['a', 'b']},
+                        {'db:ident': 'bob', 'person:name': 'bob', 'person:parent': 'ann'}])
+    assert store.match({'person:name': 'ann'}) == {'ann'}
+    assert store.retract_fact({'db:ident': 'ann', 'person:tag': ['a', 'nope']}) == 1
+    assert store.retract_fact(('ann', 'person:name', 'ann')) == 1
+    assert store.match({'person:name': 'ann'}) == set()
+    assert store.entity('ann')['person:tag'] == {'b'}
+    assert store.retract_entity('ann') == 3
+    assert store.entity('bob')['person:parent'] == []
+    codes = [store._codes.lookup(x) for x in ('ann', 'person:tag')]
+    assert not store._eav_index.get([codes[0]]) and not store._vae_index.get([codes[0]])
+    assert not store._aev_index.get([codes[1]])
+    assert store.retract_facts([{'db:ident': 'bob', 'person:name': 'bob'}, ('bob', 'person:name', 'x')]) == 1
+    assert not store._ave_index.get([store._codes.lookup('person:name')])
+    # compact reclaims the codes of what's gone, while plans, entities and caches from before keep working
+    plan = store.compile_pull(['person:name', {'person:parent': ['person:name']}])
+    bob = store.entity('bob')
+    base = len(store._codes)
+    for i in range(50):
+        store.assert_fact({'db:ident': 'tmp{}'.format(i), 'person:name': 'tmp{}'.format(i), 'person:parent': 'bob'})
+        store.retract_entity('tmp{}'.format(i))
+    store.assert_fact({'db:ident': 'cat', 'person:name': 'cat', 'person:parent': 'bob'})
+    assert store.match({'person:parent': 'bob'}) == {'cat'}
+    triples = sorted(map(str, store.triples()))
+    store.compact()
+    assert sorted(map(str, store.triples())) == triples
+    assert len(store._codes) < base + 5
+    assert store.match({'person:parent': 'bob'}) == {'cat'}
+    assert store.match({'person:name': 'cat'}) == {'cat'}
+    assert store.pull(plan, 'cat') == {'person:name': {'cat'}, 'person:parent': [{'person:name': None}]}
+    assert bob['person:_parent'][0] is store.entity('cat')
+
+
+def test_sorted_value_index_predicates():
+    store = tripl.TripleStore(schema={'bio.seq:length': {'db:index': 'db.index:sorted'},
+                                      'bio.seq:date': {'db:index': 'db.index:sorted'}})
+    store.assert_facts([{'db:ident': 's{}'.format(i), 'bio.seq:length': i * 100, 'bio.seq:plain': i * 100,
+                         'bio.seq:date': '2017-0{}-01'.format(i % 9 + 1)} for i in range(20)])
+    assert store._attr('bio.seq:length').sorted
+    assert store.match({'bio.seq:length': {'>=': 1000, '<': 1300}}) == {'s10', 's11', 's12'}
+    assert store.match({'bio.seq:plain': {'>=': 1000, '<': 1300}}) == {'s10', 's11', 's12'}
+    assert store.match({'bio.seq:length': {'>': 1800}}) == {'s19'}
+    assert store.match({'bio.seq:date': {'prefix': '2017-03'}}) == {'s2', 's11'}
+    assert store.match({'bio.seq:date': {'<=': '2017-01-01'}, 'bio.seq:length': {'<': 500}}) == {'s0'}
+    # kept up to date
+    store.assert_fact({'db:ident': 's0', 'bio.seq:length': 5000})
+    assert store.match({'bio.seq:length': {'>': 1800}}) == {'s0', 's19'}
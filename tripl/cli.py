@@ -1,36 +1,115 @@
 #!/usr/bin/env python
 
 import argparse
-import tripl
+from tripl import tripl, columnar
 import json
-import functools as fun
 import subprocess
 import multiprocessing as mp
+import collections
+import itertools
+import queue
+import sys
+
+
+class IngestError(Exception):
+    """Raised once all inputs have been ingested, if any of them failed; failures is a list of
+    (input_path, message) pairs."""
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, '{} input(s) failed to ingest'.format(len(failures)))
 
 
 def run_ingest_command(command, input_path):
+    """Run `command input_path` and parse its output as JSON. Returns (input_path, facts, error), so that a
+    failure on one input can be reported without taking the whole pool down."""
     command = command.split()
     command.append(input_path)
-    return subprocess.check_output(command)
+    try:
+        output = subprocess.check_output(command)
+    except (subprocess.CalledProcessError, OSError) as e:
+        return input_path, None, str(e)
+    try:
+        return input_path, json.loads(output.decode('utf-8')), None
+    except ValueError as e:
+        return input_path, None, 'could not parse command output as JSON: {}'.format(e)
+    except Exception as e:
+        # e.g. RecursionError on very deeply nested output
+        return input_path, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def iter_ingest_results(command, inputs, processes, max_in_flight=None):
+    """Run command over each of the inputs in a pool of processes, yielding the results of run_ingest_command
+    in the order they complete. At most max_in_flight (default twice the processes) commands are running or
+    waiting to be consumed at once, so a slow consumer doesn't let parsed output pile up in memory."""
+    max_in_flight = max_in_flight or 2 * processes
+    pending = collections.deque(inputs)
+    done = queue.Queue()
+    in_flight = 0
+    pool = mp.Pool(processes=processes)
+    try:
+        while pending or in_flight:
+            while pending and in_flight < max_in_flight:
+                input_path = pending.popleft()
+                # anything that still goes wrong (say the result can't be sent back) has to be reported too, or
+                # done.get() would wait on it forever
+                pool.apply_async(run_ingest_command, (command, input_path), callback=done.put,
+                                 error_callback=lambda e, p=input_path: done.put((p, None, str(e))))
+                in_flight += 1
+            result = done.get()
+            in_flight -= 1
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def ingest(args):
-    # Have to figure out how to handle the id attrs
     if args.map_command:
-        pool = mp.Pool(processes=args.processes)
-        run_ingest = fun.partial(run_ingest_command, args.command)
-        fact_sets = pool.map(run_ingest, args.inputs)
-        # And also finish setting up the inputs mappings
-        # Should really be doing this in a pool of workers or something
         t = tripl.TripleStore()
-        for facts in fact_sets:
-            t.assert_facts(facts, id_attrs=args.id_attrs)
+        failures = []
+        # Assert each command's output as soon as it's parsed, while the rest are still running
+        for input_path, facts, error in iter_ingest_results(args.map_command, args.inputs, args.processes):
+            if error is not None:
+                sys.stderr.write('tripl: failed to ingest {}: {}\n'.format(input_path, error))
+                failures.append((input_path, error))
+            else:
+                t.assert_facts(facts, id_attrs=args.id_attrs)
+        if failures:
+            raise IngestError(failures)
+    elif len(args.inputs) == 1 and columnar.is_columnar(args.inputs[0]):
+        # query straight off the mapped file
+        t = columnar.MappedTripleStore(args.inputs[0])
     else:
         inputs = args.inputs
-        t = tripl.TripleStore.loads(inputs, id_attrs=args.id_attrs)
+        t = tripl.TripleStore.loads(inputs, id_attrs=args.id_attrs, processes=args.processes)
     return t
 
 
+def write_pulled(results, fh, format='json', chunk_size=1000):
+    """Write pull results to fh as they come, either as a JSON array with one result per line, or as
+    newline delimited JSON (format='ndjson'), flushing every chunk_size results. Memory use doesn't grow
+    with the number of results, and whatever's reading the other end can get going straight away."""
+    # sets go out as lists; the C encoder only takes lists or tuples, so each one is copied, but only briefly
+    encode = json.JSONEncoder(default=list).encode
+    results = iter(results)
+    if format == 'json':
+        fh.write('[')
+    sep = ''
+    while True:
+        chunk = [encode(result) for result in itertools.islice(results, chunk_size)]
+        if not chunk:
+            break
+        if format == 'ndjson':
+            fh.write('\n'.join(chunk) + '\n')
+        else:
+            fh.write(sep + '\n' + ',\n'.join(chunk))
+            sep = ','
+        fh.flush()
+    if format == 'json':
+        fh.write('\n]\n')
+
+
 def cs_arg(argval):
     return argval.split(',')
 
@@ -66,7 +145,7 @@ def add_base_arguments(parser):
                         help="comma separated list of attrs to treat as unique in transactions")
     parser.add_argument('-n', '--default-namespace',
                         help="""MOCK! JSON files loaded with unnamespaced keywords will be given this namespace""")
-    parser.add_argument('-P', '--processes', type=int, default=12, help="ingest parallelism")
+    parser.add_argument('-P', '--processes', type=int, default=12, help="ingest and pull parallelism")
 
 
 def get_args():
@@ -81,6 +160,10 @@ def get_args():
                                         --map-command output interpretation as tripl data where applied, and spit out
                                          to -o tripl.json file as an eav index mapping.""")
     add_base_arguments(join_parser)  # lint
+    join_parser.add_argument('-f', '--format', choices=['json', 'snapshot', 'columnar'], default='json',
+                             help="""output format; snapshot is a binary dump of the built indexes, which loads much
+                             faster (and can be used as input to any tripl command); columnar is a read only, memory
+                             mapped file, which opens instantly as the single input to tripl pull""")
 
     # Now for pull
     pull_parser = subparsers.add_parser('pull',
@@ -91,6 +174,9 @@ def get_args():
     entities_arg = pull_parser.add_mutually_exclusive_group()
     entities_arg.add_argument('-e', '--entity-pattern', type=json_arg, help="entity pattern for which to pull")
     entities_arg.add_argument('-E', '--entities', type=cs_arg, help="comma separated list of entity ids")
+    pull_parser.add_argument('-f', '--format', choices=['json', 'ndjson'], default='json',
+                             help="""output format; a JSON array, or newline delimited JSON (one result per line);
+                             either way results are written out as they're pulled""")
     pull_parser.add_argument('-N', '--drop-namespaces',
                              help='MOCK! output results with namespaces removed from keywords')
 
@@ -101,18 +187,24 @@ def get_args():
 def _main(args):
     t = ingest(args)
     if args.subcommand == 'join':
-        t.dump(args.output)
+        t.dump(args.output, format=args.format)
     elif args.subcommand == 'pull':
+        plan = t.compile_pull(args.pull_expr)
+        # more workers than cores only adds pickling overhead
+        workers = min(args.processes, mp.cpu_count())
         with open(args.output, 'w') as fh:
-            json.dump(t.pull_many(args.pull_expr, args.entities or args.entity_pattern), fh, default=list,
-                      indent=4)
+            write_pulled(t.pull_many(plan, args.entities or args.entity_pattern, workers=workers), fh,
+                         format=args.format)
     elif args.subcommand == 'plot':
         print('Plot is not yet supported')
 
 
 def main():
     args = get_args()
-    return _main(args)
+    try:
+        return _main(args)
+    except IngestError as e:
+        sys.exit('tripl: {}'.format(e))
 
 
 if __name__ == '__main__':
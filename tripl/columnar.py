@@ -0,0 +1,366 @@
+"""
+Memory mapped, read only tripl stores.
+
+`write` lays a TripleStore out as a columnar file:
+
+* a value table of every eid, attribute and value, sorted by its serialized bytes, so that a value's code is just
+  its rank, and looking one up is a binary search
+* the triples, as parallel arrays of those codes, sorted in EAV, AEV and AVE order
+
+`MappedTripleStore` maps such a file and answers match, pull and Entity lookups by binary searching the mapped
+pages, in place of the dicts of an ordinary TripleStore. Opening one only reads the header, and every process
+mapping the same file shares one copy of it through the page cache. Since every attribute is in the AVE arrays,
+all value lookups in match are binary searches, and ref reverse lookups are answered from them as well.
+"""
+
+import array
+import bisect
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+
+from tripl.tripl import TripleStore
+
+
+MAGIC = b'tripl-columnar\n'
+VERSION = 1
+
+# Column orders of the triple arrays, as positions in (e, a, v)
+_ORDERS = (('eav', (0, 1, 2)),
+           ('aev', (1, 0, 2)),
+           ('ave', (1, 2, 0)))
+
+_HEADER_POINTER = struct.Struct('<QQ')
+
+
+def _serialize(x):
+    t = type(x)
+    if t is str:
+        return b's' + x.encode('utf-8')
+    elif t is bool:
+        return b'b1' if x else b'b0'
+    elif t is int:
+        return b'i' + str(x).encode('ascii')
+    elif t is float:
+        return b'f' + repr(x).encode('ascii')
+    elif x is None:
+        return b'n'
+    raise TypeError("Can't store {!r} in a columnar file".format(x))
+
+
+def _deserialize(raw):
+    tag, body = raw[0:1], raw[1:]
+    if tag == b's':
+        return body.decode('utf-8')
+    elif tag == b'i':
+        return int(body)
+    elif tag == b'f':
+        return float(body)
+    elif tag == b'b':
+        return body == b'1'
+    elif tag == b'n':
+        return None
+    raise ValueError("Corrupt columnar value table entry: {!r}".format(raw))
+
+
+def is_columnar(filename):
+    """True if filename is a regular file starting with the columnar magic line."""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def write(store, filename):
+    """Write store out as a columnar file, for opening with MappedTripleStore."""
+    values = store._codes.values
+    keys = [_serialize(x) for x in values]
+    if len(keys) >= 2 ** 32:
+        raise ValueError("Too many distinct values for a columnar file")
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    rank = [0] * len(keys)
+    for r, code in enumerate(order):
+        rank[code] = r
+    triples = [(rank[e], rank[a], rank[v]) for e, a, v in store._eav_index]
+
+    sections = {}
+    with open(filename, 'wb') as fp:
+        fp.write(MAGIC)
+        # pointer to the header, which goes at the end once we know where everything is
+        fp.write(_HEADER_POINTER.pack(0, 0))
+
+        def section(name, data):
+            fp.write(b'\0' * (-fp.tell() % 8))
+            sections[name] = (fp.tell(), len(data))
+            data.tofile(fp) if isinstance(data, array.array) else fp.write(data)
+
+        offsets = array.array('Q', [0])
+        for code in order:
+            offsets.append(offsets[-1] + len(keys[code]))
+        section('offsets', offsets)
+        section('values', b''.join(keys[code] for code in order))
+        for name, columns in _ORDERS:
+            triples.sort(key=lambda t: (t[columns[0]], t[columns[1]], t[columns[2]]))
+            for i, column in enumerate(columns):
+                section('{}{}'.format(name, i), array.array('I', (t[column] for t in triples)))
+
+        header = json.dumps({'version': VERSION,
+                             'byteorder': sys.byteorder,
+                             'ident_attr': store.ident_attr,
+                             'lazy_refs': store.lazy_refs,
+                             'default_cardinality': store.default_cardinality,
+                             'sections': sections}).encode('utf-8')
+        header_offset = fp.tell()
+        fp.write(header)
+        fp.seek(len(MAGIC))
+        fp.write(_HEADER_POINTER.pack(header_offset, len(header)))
+
+
+class _ValueTable(object):
+    """The sorted, serialized values of a mapped file, as a sequence (so bisect can search it). Entries are
+    sliced straight off the mmap, which hands back bytes."""
+    __slots__ = ('offsets', 'mm', 'start')
+
+    def __init__(self, offsets, mm, start):
+        self.offsets = offsets
+        self.mm = mm
+        self.start = start
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start = self.start
+        return self.mm[start + self.offsets[i]:start + self.offsets[i + 1]]
+
+
+class _MappedCodes(object):
+    """Read only stand in for a TripleStore's _Interner, over a mapped value table. Codes found by lookup are
+    remembered, since the same few attributes get looked up over and over by pull and Entity."""
+    __slots__ = ('_table', '_found')
+
+    def __init__(self, table):
+        self._table = table
+        self._found = {}
+
+    def __len__(self):
+        return len(self._table)
+
+    def lookup(self, x):
+        try:
+            key = _serialize(x)
+        except TypeError:
+            return None
+        code = self._found.get(key)
+        if code is None:
+            table = self._table
+            code = bisect.bisect_left(table, key)
+            if code < len(table) and table[code] == key:
+                self._found[key] = code
+            else:
+                return None
+        return code
+
+    def encode(self, x):
+        raise TypeError("MappedTripleStore is read only")
+
+    def decode(self, code):
+        return _deserialize(self._table[code])
+
+    @property
+    def values(self):
+        # All of them decoded, in code order, as for _Interner; only for writing the store back out
+        return [self.decode(code) for code in range(len(self._table))]
+
+    def decode_set(self, codes):
+        if codes is None:
+            return None
+        return set(self.decode(code) for code in codes)
+
+    def sizeof(self):
+        return sys.getsizeof(self)
+
+
+def _iter_distinct(column, lo, hi):
+    while lo < hi:
+        k = column[lo]
+        yield k
+        lo = bisect.bisect_right(column, k, lo, hi)
+
+
+class _MappedSubIndex(object):
+    """Read only view of the rows lo:hi of a _MappedIndex, which all share their first key; the mapped
+    counterpart of _SubIndex."""
+    __slots__ = ('k2', 'v', 'lo', 'hi')
+
+    def __init__(self, k2, v, lo, hi):
+        self.k2 = k2
+        self.v = v
+        self.lo = lo
+        self.hi = hi
+
+    def _range(self, k2):
+        if k2 is None:
+            # the code of something never seen; a dict lookup would just miss
+            return self.lo, self.lo
+        lo = bisect.bisect_left(self.k2, k2, self.lo, self.hi)
+        return lo, bisect.bisect_right(self.k2, k2, lo, self.hi)
+
+    def __iter__(self):
+        return zip(self.k2[self.lo:self.hi], self.v[self.lo:self.hi])
+
+    def items(self):
+        for k, group in itertools.groupby(self, key=lambda kv: kv[0]):
+            yield k, set(v for _, v in group)
+
+    def get(self, tupl, default=None):
+        lo, hi = self._range(tupl[0])
+        return set(self.v[lo:hi]) if lo < hi else default
+
+    def get_some(self, tupl):
+        lo, hi = self._range(tupl[0])
+        return self.v[lo] if lo < hi else None
+
+    def iterkeys(self):
+        return _iter_distinct(self.k2, self.lo, self.hi)
+
+    def count(self, tupl):
+        lo, hi = self._range(tupl[0])
+        return hi - lo
+
+    def __len__(self):
+        return sum(1 for _ in self.iterkeys())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def contains(self, tupl):
+        lo, hi = self._range(tupl[0])
+        if len(tupl) == 1:
+            return lo < hi
+        if lo == hi or tupl[1] is None:
+            return False
+        i = bisect.bisect_left(self.v, tupl[1], lo, hi)
+        return i < hi and self.v[i] == tupl[1]
+
+
+class _MappedIndex(object):
+    """Read only stand in for a TupleIndex, over three parallel, sorted (k1, k2, v) code arrays."""
+    __slots__ = ('k1', 'k2', 'v')
+
+    def __init__(self, k1, k2, v):
+        self.k1 = k1
+        self.k2 = k2
+        self.v = v
+
+    def __iter__(self):
+        return zip(self.k1, self.k2, self.v)
+
+    def _sub(self, k1):
+        if k1 is None:
+            return None
+        lo = bisect.bisect_left(self.k1, k1)
+        hi = bisect.bisect_right(self.k1, k1, lo)
+        return _MappedSubIndex(self.k2, self.v, lo, hi) if lo < hi else None
+
+    def get(self, tupl, default=None):
+        sub = self._sub(tupl[0])
+        if sub is None:
+            return default
+        elif len(tupl) == 1:
+            return sub
+        return sub.get(tupl[1:], default)
+
+    def get_some(self, tupl):
+        sub = self._sub(tupl[0])
+        if sub is None or len(tupl) == 1:
+            return sub
+        return sub.get_some(tupl[1:])
+
+    def iterkeys(self):
+        return _iter_distinct(self.k1, 0, len(self.k1))
+
+    def count(self, tupl):
+        """As TupleIndex.count, except that `[k1]` counts rows (triples) rather than distinct k2 keys, which
+        is cheaper here and near enough for planning."""
+        sub = self._sub(tupl[0])
+        if sub is None:
+            return 0
+        return sub.hi - sub.lo if len(tupl) == 1 else sub.count(tupl[1:])
+
+    def to_dict(self):
+        return {k: self._sub(k).to_dict() for k in self.iterkeys()}
+
+    def sizeof(self):
+        # All mapped, rather than private memory
+        return sys.getsizeof(self)
+
+    def contains(self, tupl):
+        sub = self._sub(tupl[0])
+        return sub is not None and (len(tupl) == 1 or sub.contains(tupl[1:]))
+
+
+class _MappedReverseIndex(object):
+    """The VAE index of a mapped store, answered out of its AVE arrays. Only (v, a) lookups are supported."""
+    __slots__ = ('ave',)
+
+    def __init__(self, ave):
+        self.ave = ave
+
+    def get(self, tupl, default=None):
+        v, a = tupl
+        return self.ave.get([a, v], default)
+
+    def count(self, tupl):
+        v, a = tupl
+        return self.ave.count([a, v])
+
+    def contains(self, tupl):
+        v, a = tupl[:2]
+        return self.ave.contains([a, v] + list(tupl[2:]))
+
+
+class MappedTripleStore(TripleStore):
+    """A read only TripleStore over a columnar file (see `write`, or `TripleStore.dump(format='columnar')`).
+    Supports everything TripleStore does for reading (match, pull, pull_many, entity, triples, dump as json or
+    columnar...), while anything that would assert or retract raises a TypeError."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not a tripl columnar file: {}".format(filename))
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        header_offset, header_size = _HEADER_POINTER.unpack_from(self._mmap, len(MAGIC))
+        header = json.loads(self._mmap[header_offset:header_offset + header_size].decode('utf-8'))
+        if header['version'] != VERSION:
+            raise ValueError("Unsupported columnar file version {} (expected {})".format(header['version'], VERSION))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("Columnar file was written on a {} endian machine".format(header['byteorder']))
+        view = memoryview(self._mmap)
+
+        def section(name, typecode):
+            offset, size = header['sections'][name]
+            return view[offset:offset + size * struct.calcsize(typecode)].cast(typecode)
+
+        # Everything is in the AVE arrays, so treat all attributes as indexed
+        self._init_state(header['ident_attr'], index_values=True)
+        self.lazy_refs = header['lazy_refs']
+        self.default_cardinality = header['default_cardinality']
+        self._codes = _MappedCodes(_ValueTable(section('offsets', 'Q'), self._mmap, header['sections']['values'][0]))
+        self._eav_index, self._aev_index, self._ave_index = [
+            _MappedIndex(*[section('{}{}'.format(name, i), 'I') for i in range(3)]) for name, _ in _ORDERS]
+        self._vae_index = _MappedReverseIndex(self._ave_index)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("MappedTripleStore is read only")
+
+    assert_fact = assert_facts = assert_schema = transaction = merge = _read_only
+    retract_fact = retract_facts = retract_entity = compact = _read_only
+    _assert_triple = _retract_triple = _read_only
+
+    def _dump_snapshot(self, filename):
+        raise TypeError("Can't snapshot a MappedTripleStore; dump it as json or columnar instead")
+
@@ -20,12 +20,25 @@ import pprint
 import copy
 import warnings
 import time
-import functools
+import bisect
+import operator
+import contextlib
+import heapq
+import itertools
+import codecs
+import re
+import multiprocessing
+import os
+import pickle
+import struct
 import sys
+import zlib
+import weakref
 
 # Constants
 # ---------
-SUPPORTED_TYPES = (str, bytes, int, float, bool, dict, Entity, uuid.UUID)
+# `Entity` gets tacked on below, once it has been defined
+SUPPORTED_TYPES = (str, bytes, int, float, bool, dict, uuid.UUID)
 try:
     # In Python 2 `str = bytes` and an additional `unicode` type is used for strings:
     SUPPORTED_TYPES += (unicode,)
@@ -70,72 +83,351 @@ def profiled(f):
     return f_
 
 
+# Streaming JSON
+# --------------
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStream(object):
+    """Incremental reader of JSON values from a file, holding little more than the value being read in memory."""
+
+    def __init__(self, fp, chunk_size, progress=None):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self.values_read = 0
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._raw_decode = json.JSONDecoder().raw_decode
+
+    def _fill(self, size=None):
+        """Read another chunk into the buffer, dropping what has already been consumed. False at end of file."""
+        if self.eof:
+            return False
+        chunk = self.fp.read(size or self.chunk_size)
+        self.bytes_read += len(chunk)
+        if isinstance(chunk, bytes):
+            chunk = self._decode(chunk, not chunk)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        if self.progress:
+            self.progress(self.values_read, self.bytes_read)
+        return not self.eof
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, or '' at end of file."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of {!r} after {} bytes of JSON, got {!r}".format(
+                chars, self.bytes_read, c or 'end of file'))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._raw_decode(self.buf, self.pos)
+                # A value running right up to the end of the buffer might be a number cut off mid way
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    self.values_read += 1
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Read in ever bigger chunks, so that values much bigger than chunk_size don't go quadratic
+            size *= 2
+            self._fill(size)
+
+
+def iter_json_facts(fp, chunk_size=2 ** 16, progress=None):
+    """Iterate over the top level facts of a JSON file without parsing it all into memory. A JSON array yields
+    its fact dicts (or eav triples, as tuples), and a JSON object is read as an EAV index (as written by
+    TripleStore.dump) one entity at a time, yielding (e, a, v) triples. If given, progress is called as
+    `progress(facts_read, bytes_read)` after every chunk read from fp."""
+    stream = _JSONStream(fp, chunk_size, progress)
+    start = stream.peek()
+    if start == '[':
+        stream.expect('[')
+        if stream.peek() == ']':
+            return
+        while True:
+            fact = stream.value()
+            yield tuple(fact) if isinstance(fact, list) else fact
+            if stream.expect(',]') == ']':
+                return
+    elif start == '{':
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            e = stream.value()
+            stream.expect(':')
+            for a, vs in stream.value().items():
+                for v in vs:
+                    yield e, a, v
+            if stream.expect(',}') == '}':
+                return
+    elif start:
+        raise ValueError("Expected a JSON array of facts or an EAV index object, got {!r}".format(start))
+
+
 # Now for the code:
 # =================
 
 
-class TupleIndex(object):
-    def __init__(self, depth=2, vals_container=set):
-        self.vals_container = vals_container
-        self.depth = depth
-        self.keys = {}
+def _box(vals):
+    """Leaf values are stored unboxed until a second one comes along; always hand them out as a set."""
+    return vals if type(vals) is set else {vals}
+
+
+class _SubIndex(object):
+    """Read only view over one `{k2: vals}` level of a TupleIndex, as returned by `TupleIndex.get([k1])`.
+    These are created on the fly rather than stored, so that the index itself doesn't pay for them."""
+    __slots__ = ('keys',)
+
+    def __init__(self, keys):
+        self.keys = keys
 
     def __iter__(self):
-        for k, vs in self.keys.items():
-            if self.depth == 1:
-                for v in vs:
+        for k, vals in self.keys.items():
+            if type(vals) is set:
+                for v in vals:
                     yield k, v
             else:
-                for tupl in vs:
-                    yield (k,) + tupl
+                yield k, vals
+
+    def items(self):
+        for k, vals in self.keys.items():
+            yield k, _box(vals)
 
     def get(self, tupl, default=None):
-        sub_index = self.keys.get(tupl[0])
+        vals = self.keys.get(tupl[0])
+        return default if vals is None else _box(vals)
+
+    def get_some(self, tupl):
+        vals = self.keys.get(tupl[0])
+        return next(iter(vals)) if type(vals) is set else vals
+
+    def iterkeys(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_dict(self):
+        return {k: _box(vals) for k, vals in self.keys.items()}
+
+    def contains(self, tupl):
         if len(tupl) == 1:
-            return sub_index or default
-        else:
-            if sub_index:
-                return sub_index.get(tupl[1:]) or default
-        return default
+            return tupl[0] in self.keys
+        vals = self.keys.get(tupl[0], _missing)
+        return tupl[1] in vals if type(vals) is set else vals == tupl[1]
+
+
+_missing = object()
+# An Entity namespace not yet looked up
+_unresolved = object()
+
+
+class TupleIndex(object):
+    """Index of (k1, k2, v) triples as two levels of plain dicts, `{k1: {k2: vals}}`.
+
+    This is built for memory more than anything. There are no wrapper objects per key (`get([k1])` hands out a
+    throwaway _SubIndex view), a lone value is stored unboxed and only becomes a set when a second value is
+    added, and emptied levels are pruned on remove. Sets handed out by `get` for lone values are fresh, so all
+    writes have to go through `add` and `remove`."""
+    __slots__ = ('keys',)
+
+    def __init__(self, depth=2, vals_container=set):
+        # depth and vals_container are only accepted for compatibility; these are always triple indexes
+        self.keys = {}
+
+    def __iter__(self):
+        for k1, sub in self.keys.items():
+            for k2, vals in sub.items():
+                if type(vals) is set:
+                    for v in vals:
+                        yield k1, k2, v
+                else:
+                    yield k1, k2, vals
+
+    def get(self, tupl, default=None):
+        sub = self.keys.get(tupl[0])
+        if sub is None:
+            return default
+        elif len(tupl) == 1:
+            return _SubIndex(sub)
+        vals = sub.get(tupl[1])
+        return default if vals is None else _box(vals)
 
     def get_some(self, tupl):
-        return some(self.get(tupl))
+        sub = self.keys.get(tupl[0])
+        if sub is None:
+            return None
+        elif len(tupl) == 1:
+            return _SubIndex(sub)
+        vals = sub.get(tupl[1])
+        return next(iter(vals)) if type(vals) is set else vals
 
     def add(self, tupl):
-        sub_index = self.keys.get(tupl[0])
-        if len(tupl) == 2:
-            if not sub_index:
-                self.keys[tupl[0]] = self.vals_container()
-            k = tupl[0]
-            try:
-                self.keys[k].add(tupl[1])
-            except TypeError as e:
-                warnings.warn("Unable to hash key: {}".format(k))
-                warnings.warn("Value is: {}".format(tupl[1]))
-                warnings.warn("Are you trying to write a list as an individual value? This is not supported by tripl.")
-                raise e
-        else:
-            if not sub_index:
-                sub_index = TupleIndex(depth=self.depth - 1, vals_container=self.vals_container)
-                self.keys[tupl[0]] = sub_index
-            sub_index.add(tupl[1:])
-
-    def retract(self, tupl):
-        sub_index = self.keys.get(tupl[0])
-        if sub_index and len(tupl) == 2:
-            sub_index.remove(tupl[1])
+        k1, k2, v = tupl
+        sub = self.keys.get(k1)
+        if sub is None:
+            sub = self.keys[k1] = {}
+        vals = sub.get(k2, _missing)
+        try:
+            if vals is _missing:
+                # sets would have checked this for us
+                hash(v)
+                sub[k2] = v
+            elif type(vals) is set:
+                vals.add(v)
+            elif vals != v:
+                sub[k2] = {vals, v}
+        except TypeError as e:
+            warnings.warn("Unable to hash key: {}".format(k2))
+            warnings.warn("Value is: {}".format(v))
+            warnings.warn("Are you trying to write a list as an individual value? This is not supported by tripl.")
+            raise e
+
+    def add_group(self, k1, items):
+        """Add (k1, k2, v) for every (k2, v) in items; a faster `add` for batches sharing their first key."""
+        sub = self.keys.get(k1)
+        if sub is None:
+            sub = self.keys[k1] = {}
+        for k2, v in items:
+            vals = sub.get(k2, _missing)
+            if vals is _missing:
+                sub[k2] = v
+            elif type(vals) is set:
+                vals.add(v)
+            elif vals != v:
+                sub[k2] = {vals, v}
+
+    def remove(self, tupl):
+        """Remove the (k1, k2, v) triple if present, pruning any levels of the index left empty. Returns whether
+        it was present."""
+        k1, k2, v = tupl
+        sub = self.keys.get(k1)
+        if sub is None:
+            return False
+        vals = sub.get(k2, _missing)
+        if type(vals) is set:
+            if v not in vals:
+                return False
+            vals.discard(v)
+            if len(vals) == 1:
+                sub[k2] = next(iter(vals))
+        elif vals is not _missing and vals == v:
+            del sub[k2]
+            if not sub:
+                del self.keys[k1]
         else:
-            sub_index.retract(tupl[1:])
+            return False
+        return True
+
+    retract = remove
+
+    def iterkeys(self):
+        return iter(self.keys)
+
+    def count(self, tupl):
+        """Number of entries under the key prefix tupl (k2 keys for `[k1]`, values for `[k1, k2]`), straight
+        from the dict sizes. This is what match plans with."""
+        sub = self.keys.get(tupl[0])
+        if sub is None:
+            return 0
+        elif len(tupl) == 1:
+            return len(sub)
+        vals = sub.get(tupl[1], _missing)
+        return 0 if vals is _missing else len(vals) if type(vals) is set else 1
 
     def to_dict(self):
-        return {k: v.to_dict() if self.depth > 1 else v for k, v in self.keys.items()}
+        return {k: {k2: _box(vals) for k2, vals in sub.items()} for k, sub in self.keys.items()}
+
+    def sizeof(self):
+        """Approximate memory footprint in bytes of the index structure itself (not counting the keys and
+        values, which are shared between indexes)."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.keys)
+        for sub in self.keys.values():
+            size += sys.getsizeof(sub)
+            for vals in sub.values():
+                if type(vals) is set:
+                    size += sys.getsizeof(vals)
+        return size
 
     def contains(self, tupl):
-        return (tupl[0] in self.keys) \
-               and (len(tupl) == 1
-                    or (tupl[1] in self.keys[tupl[0]]
-                        if self.depth == 1
-                        else self.get([tupl[0]]).contains(tupl[1:])))
+        sub = self.keys.get(tupl[0])
+        if sub is None:
+            return False
+        return len(tupl) == 1 or _SubIndex(sub).contains(tupl[1:])
+
+
+def _intern_key(x):
+    # Keep e.g. `1`, `1.0` and `True` apart, which would otherwise collide as dict keys
+    return x if type(x) is str else (type(x), x)
+
+
+class _Interner(object):
+    """Dictionary encoding of every eid, attribute and value in a TripleStore as a dense int. The indexes only
+    ever hold these codes; they get decoded back at the API boundary (pull, Entity, match, dump...). Since refs
+    are stored as the code of the eid they point to, ref joins are int set operations."""
+    __slots__ = ('_codes', 'values')
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self._codes = {_intern_key(x): code for code, x in enumerate(self.values)}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, x):
+        """Return the code for x, assigning a new one if x hasn't been seen before."""
+        # _intern_key, inlined; this is on the assert hot path
+        key = x if type(x) is str else (type(x), x)
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.values)
+            self.values.append(x)
+        return code
+
+    def lookup(self, x):
+        """Return the code for x, or None if x has never been encoded. Doesn't assign new codes."""
+        try:
+            return self._codes.get(_intern_key(x))
+        except TypeError:
+            # unhashable, so can't be in the store
+            return None
+
+    def decode(self, code):
+        return self.values[code]
+
+    def decode_set(self, codes):
+        if codes is None:
+            return None
+        values = self.values
+        return set(values[code] for code in codes)
+
+    def sizeof(self):
+        size = sys.getsizeof(self._codes) + sys.getsizeof(self.values)
+        return size + sum(sys.getsizeof(key) for key in self._codes if type(key) is tuple)
 
 
 # def _triple_index(vals_container=set):
@@ -145,50 +437,246 @@ def _triple_index(vals_container=set):
     return TupleIndex()
 
 
+# Binary snapshots
+# ----------------
+#
+# A snapshot is the already built, encoded state of a TripleStore: the magic line, then a pickled header (format
+# version and store settings), then the pickled code table and raw index dicts. Loading one is a couple of
+# unpickles, with none of the assert pipeline. As with any pickle, only load snapshots you trust.
+
+SNAPSHOT_MAGIC = b'tripl-snapshot\n'
+SNAPSHOT_VERSION = 1
+
+
+def is_snapshot(fp):
+    """True if the buffered binary file fp starts with the tripl snapshot magic line. Only peeks, so fp can
+    still be read from the start either way (even if it's a pipe)."""
+    return fp.peek(len(SNAPSHOT_MAGIC))[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC
+
+
+def _read_snapshot(fp):
+    if fp.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError('Not a tripl snapshot')
+    header = pickle.load(fp)
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError('Unsupported tripl snapshot version {} (expected {})'.format(
+            header.get('version'), SNAPSHOT_VERSION))
+    return header, pickle.load(fp)
+
+
+LOG_MAGIC = b'tripl-log\n'
+LOG_VERSION = 1
+
+# Log records are a (length, crc32) prefix, then that many bytes of pickle
+_LOG_RECORD = struct.Struct('<II')
+
+
+def _write_log_record(fp, record):
+    data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    fp.write(_LOG_RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+
+
+def _read_log_records(fp):
+    """Yield (record, offset after it) for each complete record of the log fp, positioned just past the magic
+    line. Stops at the first torn or corrupt record, as left by a crash mid write."""
+    while True:
+        prefix = fp.read(_LOG_RECORD.size)
+        if len(prefix) < _LOG_RECORD.size:
+            return
+        size, crc = _LOG_RECORD.unpack(prefix)
+        data = fp.read(size)
+        if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+            return
+        yield pickle.loads(data), fp.tell()
+
+
+class _MatchPlan(list):
+    """The (attr, vals) clauses of a match pattern, cheapest first, where vals are either value codes or the
+    _MatchPlan of a nested pattern. cost is that of the cheapest clause."""
+    __slots__ = ('cost',)
+
+
+# Predicate clauses in match patterns, as {op: bound}
+_PREDICATES = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+               'prefix': lambda x, prefix: x.startswith(prefix)}
+
+
+def _is_predicate(v):
+    return isinstance(v, dict) and bool(v) and all(op in _PREDICATES for op in v)
+
+
+def _sort_rank(x):
+    # Numbers and strings are kept apart in sorted value indexes, since they don't compare; anything else is
+    # left out (None)
+    t = type(x)
+    if t is int or t is float:
+        return 0
+    elif t is str:
+        return 1
+
+
+def _predicate_rank(predicate):
+    """The _sort_rank of the values a predicate can match, or None if it can't match anything."""
+    ranks = set(_sort_rank(bound) for bound in predicate.values())
+    if None in ranks or ('prefix' in predicate and ranks != {1}):
+        raise ValueError('Bad match predicate {!r}; bounds have to be numbers or strings, and prefixes strings'
+                         .format(predicate))
+    return ranks.pop() if len(ranks) == 1 else None
+
+
+class _MatchCache(object):
+    """Bounded LRU cache of match results (encoded eid sets), keyed by normalized pattern (see
+    TripleStore._match_key). entries map keys to (eids, deps), where deps are the codes of the attributes the
+    pattern mentions, and by_attr indexes keys by those codes, so that a write to an attribute drops just the
+    entries depending on it."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.by_attr = {}
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, eids, deps):
+        self.entries[key] = (eids, deps)
+        for a in deps:
+            self.by_attr.setdefault(a, set()).add(key)
+        while len(self.entries) > self.size:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, deps = self.entries.pop(key)
+        for a in deps:
+            keys = self.by_attr[a]
+            keys.discard(key)
+            if not keys:
+                del self.by_attr[a]
+
+    def invalidate(self, a):
+        for key in list(self.by_attr.get(a, ())):
+            self._drop(key)
+            self.invalidations += 1
+
+    def stats(self):
+        return {'size': len(self.entries), 'capacity': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+class _PullPlan(object):
+    """A pull expression compiled against a store (see TripleStore.compile_pull). attrs are the plain
+    (attr, code, card_one) attributes to pull; links the (attr, _link, sub plan, card_one) dict patterns and
+    reverse lookups, where a None sub plan is a `'...'` recursion point back into base, the plan at the top;
+    recursive those links; and star whether there's a `'*'`, with star_attrs caching the attrs it comes across
+    by code.
+
+    A plan is closed if there's no recursion anywhere in it, so that what it pulls for an entity depends only
+    on the entity. Closed sub plans memoize their results by eid in memo, and deps are the attribute codes
+    those results depend on (None for any attribute at all). The base plan lists the sub plans with memos in
+    memoized, which only last a single pull or pull_many call unless memoize is set."""
+    __slots__ = ('store', 'codes', 'expr', 'base', 'attrs', 'links', 'recursive', 'star', 'star_attrs', 'closed',
+                 'deps', 'memo', 'memoize', 'memoized', '__weakref__')
+
+    def __init__(self, store, expr):
+        self.store = store
+        # the store's interner when compiled; compact can replace it, along with every code
+        self.codes = store._codes
+        self.expr = expr
+        self.base = None
+        self.attrs = []
+        self.links = []
+        self.recursive = []
+        self.star = False
+        self.star_attrs = {}
+        self.closed = False
+        self.deps = None
+        self.memo = None
+        self.memoize = False
+        self.memoized = []
+
+
 # Would be great to implement something analagous to the entity API, but would need to have schema I think
 # to traverse the references
 class Entity(object):
-    def __init__(self, graph, ident, namespace=None):
-        self._graph = graph
-        # TODO Should allow for entity in leiu of ident
-        self.ident = ident
-        self._entity = graph._eav_index.get([ident])
-        # Question: Should we call this type or namespace?
-        self.namespace = namespace
-        self.namespace = namespace or graph._eav_index.get_some([ident, 'tripl:type'])
+    """Read only view of an entity in a graph (TripleStore). There's only ever one Entity per graph, class, ident
+    and namespace argument at a time (the graph keeps a weak identity map of them), so following the same
+    references over and over doesn't pile up copies. Everything is read from the graph's indexes as needed, so
+    an Entity is never out of date."""
+    __slots__ = ('_graph', 'ident', '_code', '_namespace', '__weakref__')
+
+    def __new__(cls, graph, ident, namespace=None):
+        key = (cls, ident, namespace)
+        self = graph._entity_map.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            self._graph = graph
+            # TODO Should allow for entity in leiu of ident
+            self.ident = ident
+            self._code = graph._codes.lookup(ident)
+            self._namespace = namespace or _unresolved
+            graph._entity_map[key] = self
+        return self
+
+    @property
+    def _eid(self):
+        # The encoded eid, as used in the graph's indexes; None until the ident has been asserted
+        eid = self._code
+        if eid is None:
+            eid = self._code = self._graph._codes.lookup(self.ident)
+        return eid
+
+    @property
+    def _entity(self):
+        # (empty for an ident with nothing asserted about it, e.g. since it was retracted)
+        return self._graph._eav_index.get([self._eid]) or _SubIndex({})
+
+    # Question: Should we call this type or namespace?
+    @property
+    def namespace(self):
+        namespace = self._namespace
+        if namespace is _unresolved:
+            # looked up every time, since tripl:type may be asserted after the Entity was made
+            namespace = some(self._graph._get(self._eid, 'tripl:type'))
+        return namespace
+
+    @namespace.setter
+    def namespace(self, namespace):
+        self._namespace = namespace
 
     def __repr__(self):
         r = self.namespace + ':' if self.namespace else ''
-        return r + str({k: self._entity.get([k]) for k in self.keys()})
+        return r + str({k: self._graph._get(self._eid, k) for k in self.keys()})
 
     def __getitem__(self, key):
         # This is really the only magic to this object, over just looking at the EAV index
-        # Should probably have these globally cached or something, so we don't create dups?
         # lazy_ref means that we allow you to infer relationships without assigning a reference type
-        if self.namespace and len(key.split(':')) == 1:
+        graph = self._graph
+        attr = graph._attr(key)
+        if self.namespace and attr.namespace is None:
             return self.__getitem__(self.namespace + ':' + key)
+        decode = graph._codes.decode
         # reverse lookup ref
-        if str(key).split(':')[-1][0:1] == '_':
-            namespace, name = key.split(':')
-            name = name[1:]
-            key = namespace + ':' + name
-            if self._graph._ref_attr(key):
-                return list(type(self)(self._graph, v) for v in self._graph._vae_index.get([self.eid, key]))
-            elif self._graph.lazy_refs:
-                return list(type(self)(self._graph, e)
-                            for e, vs in self._graph._aev_index.get([key]).keys.items()
-                            if self.ident in vs)
+        if attr.reverse:
+            if attr.ref or graph.lazy_refs:
+                return list(type(self)(graph, decode(e)) for e in graph._neighbors(attr.attr, self._eid))
             else:
                 return []
+        a = graph._codes.lookup(key)
+        vals = self._entity.get([a])
         # reference
-        if self._graph._ref_attr(key) or \
-                (self._graph.lazy_refs
-                 and self._entity.get([key])
-                 and all(self._graph._eav_index.contains([v]) for v in self._entity.get([key]))):
-            results = [type(self)(self._graph, ident) for ident in self._entity.get([key])]
+        if attr.ref or (graph.lazy_refs and vals and graph._lazy_ref(a, vals)):
+            results = [type(self)(graph, decode(v)) for v in vals or []]
         else:
-            results = self._entity.get([key])
-        if self._graph._card_one(key):
+            results = graph._codes.decode_set(vals)
+        if attr.card_one:
             return some(results)
         else:
             return results
@@ -241,13 +729,16 @@ class Entity(object):
         return some(self.get_in(keys), default=default)
 
     def __getattr__(self, key):
+        if key in Entity.__slots__ or key.startswith('__'):
+            # not attribute lookups; e.g. an unset slot, or copy/pickle protocol probing
+            raise AttributeError(key)
         if self.namespace and len(key.split(':')) == 1:
             return self[self.namespace + ':' + key]
         else:
             return self[key]
 
     def __contains__(self, key):
-        if key in self._entity.keys:
+        if self._entity.contains([self._graph._codes.lookup(key)]):
             return True
         else:
             if str(key).split(':')[-1][0:1] == '_':
@@ -255,11 +746,11 @@ class Entity(object):
                 return self._graph._ref_attr(key)
 
     def __len__(self):
-        return len(self._entity.keys)
+        return len(self._entity)
 
     def keys(self):
         if self._entity:
-            keys = self._entity.keys.keys()
+            keys = [self._graph._codes.decode(a) for a in self._entity.iterkeys()]
             if 'db:ident' not in keys:
                 return ['db:ident'] + keys
             return keys
@@ -267,6 +758,9 @@ class Entity(object):
             return []
 
 
+SUPPORTED_TYPES += (Entity,)
+
+
 # def generate_entity_class(name, namespace):
 #     return type(name, (Entity), {
 
@@ -278,6 +772,58 @@ def reverse_lookup(attr_name):
         return ':'.join(parts)
 
 
+# Everything the assert and read paths need to know about an attribute, derived once from the schema and cached
+# per store (see TripleStore._attr). `reverse` is the forward attribute for `ns:_attr` style reverse lookups.
+# `indexed` means values of the attribute are kept in the AVE index (see TripleStore._entity_lookup), `unique`
+# that they are `db.unique:identity` values, resolved through TripleStore._unique_index, and `sorted` that range
+# and prefix predicates on them are answered from a sorted value index (`db:index db.index:sorted`; see
+# TripleStore._sorted_values).
+_AttrDescriptor = collections.namedtuple('_AttrDescriptor', ['attr', 'namespace', 'name', 'reverse', 'card_one',
+                                                             'ref', 'indexed', 'unique', 'sorted'])
+
+# Schema attributes which, when asserted or retracted, invalidate cached attribute descriptors
+_DESCRIPTOR_META_ATTRS = frozenset(['db:cardinality', 'db:valueType', 'db:index', 'db:unique'])
+
+
+class _TempId(object):
+    """Placeholder for the eid of the nth entity in a bulk transaction, until identities are resolved."""
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class Transaction(object):
+    """Collects facts to be asserted in bulk when the `TripleStore.transaction()` block exits. The transaction
+    report (see `TripleStore.assert_facts`) is available as `report` afterwards."""
+
+    def __init__(self, id_attrs=None):
+        self.id_attrs = id_attrs
+        self.facts = []
+        self.report = None
+
+    def assert_fact(self, fact):
+        self.facts.append(fact)
+
+    def assert_facts(self, facts):
+        if isinstance(facts, dict):
+            # eav index
+            self.facts.extend((e, a, v) for e, d in facts.items() for a, vs in d.items() for v in vs)
+        elif isinstance(facts, TripleStore):
+            self.facts.extend(facts.triples())
+        else:
+            self.facts.extend(facts)
+
+
+class IdentityConflictWarning(UserWarning):
+    """Issued once per assert_fact/assert_facts call in which identity values disagreed about which entity they
+    belong to. The `conflicts` attribute holds all of them as `(attr, value, eid, other_eid)` tuples."""
+
+    def __init__(self, message, conflicts):
+        super(IdentityConflictWarning, self).__init__(message)
+        self.conflicts = conflicts
+
+
 def base_schema(ident_attr):
     return [{ident_attr: 'db:schema',
              'db:attributes': [
@@ -291,6 +837,10 @@ def base_schema(ident_attr):
                  {ident_attr: 'db.schema:types',
                   'db:cardinality': 'db.cardinality:many',
                   'db:valueType': 'db.type:ref'},
+                 {ident_attr: 'db:index',
+                  'db:cardinality': 'db.cardinality:one'},
+                 {ident_attr: 'db:unique',
+                  'db:cardinality': 'db.cardinality:one'},
                  {ident_attr: 'db.refs:lazy',
                   'db:cardinality': 'db.cardinality:one'},
                  {ident_attr: 'db.cardinality:default',
@@ -302,7 +852,7 @@ class TripleStore(object):
     #     if
 
     def __init__(self, schema=None, facts=None, lazy_refs=None, default_cardinality=None, types=None,
-                 ident_attr="db:ident", id_attrs=None):
+                 ident_attr="db:ident", id_attrs=None, index_values=False, match_cache_size=None):
         """Construct a new TripleStore instance, with the optional facts attribute asserted as via
         assert_facts. The schema can be specified by the facts data, by the schema attribute, and by the
         global default setting kw attrs in this signature, and precedence is taken in that order.
@@ -312,19 +862,23 @@ class TripleStore(object):
         The schema dict should map attribute names to schema attributes (`db:cardinality` and
         `db:valueType: db.type:ref` only for the moment), and should not be updated once set (for now at
         least). Additional options are:
+
+        * `index_values`: keep every non-ref attribute in the AVE (attribute -> value -> entities) index, so
+          that `match` lookups on them are hash lookups instead of scans. Individual attributes can instead
+          opt in via `db:index true` in their schema. See `index_stats` for what this costs.
+        * `id_attrs`: attributes to treat as unique when asserting `facts`. These are declared
+          `db:unique db.unique:identity` in the schema, so that they keep resolving to the same entities in
+          later assert_facts calls (as in `loads`).
+        * `match_cache_size`: keep the results of up to this many distinct match patterns, least recently used
+          first out, until there's a write to an attribute they mention. See `match_cache_stats`.
         """
         # 1. Load all facts, which may include schema
         #
         # Start by assuming everything cardinality many with lazy refs, to load everything without conflict
-        self.default_cardinality = 'db.cardinality:many'
-        self.lazy_refs = True
-        # Set up index
-        self._eav_index = _triple_index(vals_container=set)
-        self._aev_index = _triple_index(vals_container=set)
-        self._vae_index = _triple_index(vals_container=set)
-        # This must be statically set for now? Should check compatibility with facts?
-        self.ident_attr = ident_attr
+        self._init_state(ident_attr, index_values=index_values, match_cache_size=match_cache_size)
         self.assert_facts(base_schema(self.ident_attr))
+        if id_attrs:
+            self.assert_schema({a: {'db:unique': 'db.unique:identity'} for a in id_attrs})
         if facts:
             self.assert_facts(facts, id_attrs=id_attrs)
 
@@ -335,7 +889,9 @@ class TripleStore(object):
         # 3. Query current schema, and update with kw_args as appropriate, and cache as attributes
         # (semi-static; could generalize with method calls based on schema)
         schema_pull = self.pull(['*'], 'db:schema')
-        lazy_refs = lazy_refs or some(schema_pull.get('db.refs:lazy'))
+        if lazy_refs is None:
+            # (an explicit False has to win over the schema)
+            lazy_refs = some(schema_pull.get('db.refs:lazy'))
         self.lazy_refs = True if lazy_refs is None else lazy_refs
         # Setting default cardinality
         default_cardinality = default_cardinality or some(schema_pull.get('db.cardinality:default'))
@@ -357,6 +913,51 @@ class TripleStore(object):
         # if facts:
         #     self.assert_facts(facts, id_attrs=id_attrs)
 
+    def _init_state(self, ident_attr, index_values=False, match_cache_size=None):
+        """Set up a store with nothing in it, not even the base schema. Shared with columnar.MappedTripleStore,
+        which then swaps in its own _codes and indexes."""
+        self._attr_cache = {}
+        self._index_values = index_values
+        # Write ahead logging (see open); the (assert?, e, a, v) writes of the current call, while logging
+        self._log = None
+        self._log_batch = None
+        self._log_generation = 0
+        self._snapshot_path = None
+        self._log_sync = True
+        self._compact_at = None
+        # Lazy ref classification of attributes by code: whether all ('ref'), none ('plain') or some ('mixed')
+        # of their values are eids; see _lazy_ref
+        self._ref_classes = {}
+        # Sorted value indexes, {attr code: (keys, codes)}; see _sorted_values
+        self._sorted_indexes = {}
+        # Attributes reverse looked up as lazy refs, which are kept in the AVE index from then on; see _link
+        self._lazy_ref_attrs = set()
+        self.default_cardinality = 'db.cardinality:many'
+        self.lazy_refs = True
+        self.types = None
+        # Set up index; everything in them is dictionary encoded through _codes
+        self._codes = _Interner()
+        self._eav_index = _triple_index(vals_container=set)
+        self._aev_index = _triple_index(vals_container=set)
+        self._vae_index = _triple_index(vals_container=set)
+        # Value index, for attributes marked `db:index` (or all non-ref attributes, with index_values)
+        self._ave_index = _triple_index(vals_container=set)
+        # Identity index for `db:unique` attributes: {attr: {value: eid}} (all encoded)
+        self._unique_index = {}
+        self._conflicts = []
+        # Memoizing pull plans, by weak reference; see _PullPlan
+        self._pull_memos = weakref.WeakSet()
+        # The codes of the attributes something derived (pull memos, cached matches, sorted indexes) depends on,
+        # so that writes to them go through _attr_written
+        self._watched = set()
+        # Whether every write needs to go through _attr_written, for something depending on all attributes
+        self._watch_all = False
+        self.match_cache_size = match_cache_size
+        # Entity identity map; see Entity
+        self._entity_map = weakref.WeakValueDictionary()
+        # This must be statically set for now? Should check compatibility with facts?
+        self.ident_attr = ident_attr
+
     # Should define triples iterator
     # Define write to file
 
@@ -376,71 +977,317 @@ class TripleStore(object):
         if attr and meta_attr:
             # This could be optimized
             # return some(self.schema(attr).get(meta_attr))
-            return self._eav_index.get([attr, meta_attr])
+            return self._get(self._codes.lookup(attr), meta_attr)
         elif attr:
             # Could work to get the cards right here
-            _entity = self._eav_index.get([attr])
-            return _entity.to_dict().copy() if _entity else {}  # Will this work? XXX
+            _entity = self._eav_index.get([self._codes.lookup(attr)])
+            return self._decode_entity(_entity) if _entity else {}
         else:
-            return [self.schema(a) for a in self._eav_index.get(['db:schema', 'db:attributes'])]
+            return [self.schema(a) for a in self._get(self._codes.lookup('db:schema'), 'db:attributes')]
+
+    def triples(self):
+        """Iterate over all (e, a, v) triples in the store."""
+        decode = self._codes.decode
+        for e, a, v in self._eav_index:
+            yield decode(e), decode(a), decode(v)
+
+    @property
+    def default_cardinality(self):
+        return self._default_cardinality
+
+    @default_cardinality.setter
+    def default_cardinality(self, cardinality):
+        # Every cached descriptor may have been derived from the old default
+        self._default_cardinality = cardinality
+        self._attr_cache.clear()
+
+    @property
+    def match_cache_size(self):
+        return self._match_cache.size if self._match_cache else None
+
+    @match_cache_size.setter
+    def match_cache_size(self, size):
+        # None or 0 turns the cache off
+        self._match_cache = _MatchCache(size) if size else None
+
+    def match_cache_stats(self):
+        """Report the match cache's size and capacity, and its hit, miss, eviction and invalidation counts, or
+        None if there's no match cache."""
+        return self._match_cache.stats() if self._match_cache else None
 
     # Some implementation details:
 
-    def _attr_cardinality(self, attr):
-        attr_schema = self.schema(attr)
-        if attr_schema:
-            return some(attr_schema.get('db:cardinality', [self.default_cardinality]))
-
-    def _attr_type(self, attr):
+    def _attr(self, attr):
+        """Return the _AttrDescriptor for attr, deriving it from the schema only on a cache miss."""
+        try:
+            return self._attr_cache[attr]
+        except KeyError:
+            descriptor = self._attr_cache[attr] = self._describe_attr(attr)
+            return descriptor
+
+    def _describe_attr(self, attr):
+        namespace, _, name = str(attr).rpartition(':')
+        namespace = namespace or None
+        reverse = None
+        if name[0:1] == '_':
+            reverse = namespace + ':' + name[1:] if namespace else name[1:]
+        if reverse:
+            # Just always assume sets for reverse lookups
+            # Todo; if you have a unique attribute here, you can do one-one
+            return _AttrDescriptor(attr, namespace, name, reverse, False, self._attr(reverse).ref, False, False,
+                                   False)
         attr_schema = self.schema(attr)
         if attr_schema:
-            schema = attr_schema.get('db:valueType')
-            return some(schema) if schema else None
+            cardinality = some(attr_schema.get('db:cardinality', [self.default_cardinality]))
+            value_type = attr_schema.get('db:valueType')
+            value_type = some(value_type) if value_type else None
+            index = some(attr_schema.get('db:index'))
+            unique = some(attr_schema.get('db:unique')) == 'db.unique:identity'
+        else:
+            cardinality = value_type = index = unique = None
+        card_one = attr == 'db:cardinality' or cardinality == 'db.cardinality:one'
+        ref = value_type == 'db.type:ref'
+        # Refs are already covered by the vae index
+        indexed = not ref and bool(index or self._index_values or attr in self._lazy_ref_attrs)
+        return _AttrDescriptor(attr, namespace, name, None, card_one, ref, indexed, bool(unique),
+                               not ref and index == 'db.index:sorted')
+
+    def _invalidate_attr(self, attr):
+        """Drop the cached descriptors for attr and its reverse lookup form, after a change to its schema."""
+        self._attr_cache.pop(attr, None)
+        namespace, _, name = str(attr).rpartition(':')
+        self._attr_cache.pop(namespace + ':_' + name if namespace else '_' + name, None)
+
+    def _schema_changed(self, triple):
+        e, a, v = triple
+        if a in _DESCRIPTOR_META_ATTRS:
+            self._invalidate_attr(e)
+            code = self._codes.lookup(e)
+            if self._attr(e).indexed != bool(self._ave_index.get([code])):
+                self._reindex_values(e)
+            if self._attr(e).unique != (code in self._unique_index):
+                self._reindex_unique(e)
+        elif a == 'db.cardinality:default':
+            self._attr_cache.clear()
+
+    def _reindex_values(self, attr):
+        """(Re)build or drop the AVE entries for attr, after it has been marked or unmarked as indexed."""
+        a = self._codes.lookup(attr)
+        self._ave_index.keys.pop(a, None)
+        if self._attr(attr).indexed:
+            for e, v in (self._aev_index.get([a]) or []):
+                self._ave_index.add([a, v, e])
+
+    def _reindex_unique(self, attr):
+        """(Re)build or drop the identity map for attr, after it has been marked or unmarked `db:unique`."""
+        a = self._codes.lookup(attr)
+        self._unique_index.pop(a, None)
+        if self._attr(attr).unique:
+            self._unique_index[a] = {}
+            for e, v in (self._aev_index.get([a]) or []):
+                self._index_unique(e, a, v)
+
+    def _index_unique(self, e, a, v):
+        ids = self._unique_index[a]
+        other = ids.get(v)
+        if other is not None and other != e:
+            decode = self._codes.decode
+            self._conflicts.append((decode(a), decode(v), decode(e), decode(other)))
+        ids[v] = e
+
+    def _attr_written(self, a):
+        """Drop everything derived from the attribute with code a (which is in _watched, or everything is), after
+        a write to it."""
+        for plan in list(self._pull_memos):
+            if plan.deps is None or a in plan.deps:
+                plan.memo.clear()
+                self._pull_memos.discard(plan)
+        if self._match_cache is not None:
+            self._match_cache.invalidate(a)
+        self._sorted_indexes.pop(a, None)
+        self._watched.discard(a)
+        self._watch_all = False
+
+    def _lazy_ref(self, a, vals):
+        """Whether the value codes vals of the attribute with code a are all eids, and so (lazy) refs. Whole
+        attributes are classified on first use, and kept up to date as they're written (see _classify_write),
+        so this only has to check each value for attributes with a mix of eids and other values."""
+        cls = self._ref_classes.get(a)
+        if cls is None:
+            contains = self._eav_index.contains
+            eids = others = False
+            for _, v in self._aev_index.get([a], ()):
+                if contains([v]):
+                    eids = True
+                else:
+                    others = True
+                if eids and others:
+                    break
+            cls = self._ref_classes[a] = 'mixed' if eids and others else 'ref' if eids else 'plain'
+        if cls == 'mixed':
+            contains = self._eav_index.contains
+            return all(contains([v]) for v in vals)
+        return cls == 'ref'
+
+    def _new_eids(self, pairs, fresh):
+        """The eids of the encoded (e, v) pairs about to be asserted which aren't entities yet, but whose codes
+        are older than fresh (the interner's length before the write), and so might already be values."""
+        contains = self._eav_index.contains
+        return set(e for e, _ in pairs if e < fresh and not contains([e]))
+
+    def _classify_write(self, groups, new_eids=()):
+        """Update _ref_classes after the encoded (e, v) pairs of each (attribute code, pairs) in groups have been
+        asserted. new_eids are from _new_eids, from before the write."""
+        for e in new_eids:
+            self._reclassify_eid(e, 'plain')
+        contains = self._eav_index.contains
+        for a, pairs in groups:
+            cls = self._ref_classes.get(a)
+            if cls == 'ref' or cls == 'plain':
+                eids = [contains([v]) for _, v in pairs]
+                if (cls == 'ref' and not all(eids)) or (cls == 'plain' and any(eids)):
+                    self._ref_classes[a] = 'mixed'
+
+    def _reclassify_eid(self, e, cls):
+        """The encoded e just became an entity (cls 'plain') or stopped being one (cls 'ref'), so attributes of
+        class cls with e among their values are now mixed. Only attributes whose values are indexed in VAE or
+        AVE can be checked without a scan; others are forgotten, and classified again when next read."""
+        decode = self._codes.decode
+        for b, c in list(self._ref_classes.items()):
+            if c == cls:
+                if self._vae_index.contains([e, b]) or self._ave_index.contains([b, e]):
+                    self._ref_classes[b] = 'mixed'
+                else:
+                    descriptor = self._attr(decode(b))
+                    if not (descriptor.ref or descriptor.indexed):
+                        del self._ref_classes[b]
+
+    def _write_done(self):
+        # End of a public write call
+        if self._log_batch:
+            self._flush_log()
+        self._report_conflicts()
+
+    def _report_conflicts(self):
+        if self._conflicts:
+            conflicts, self._conflicts = self._conflicts, []
+            warnings.warn(IdentityConflictWarning(
+                "{} identity conflicts while asserting facts; e.g. {}".format(len(conflicts), conflicts[:3]),
+                conflicts))
 
     def _ref_attr(self, attr):
-        lookup = reverse_lookup(attr)
-        if lookup:
-            return self._ref_attr(lookup)
-        else:
-            return self._attr_type(attr) == 'db.type:ref'
+        return self._attr(attr).ref
 
     def _card_one(self, attr):
-        lookup = reverse_lookup(attr)
-        if lookup:
-            # Just always assume sets for reverse lookups
-            return False
-            # Todo; if you have a unique attribute here, you can do one-one
-            # return blah if self._unique(lookup) else blah
-        elif attr == 'db:cardinality':
-            return 'db.cardinality:one'
-        else:
-            return self._attr_cardinality(attr) == 'db.cardinality:one'
+        return self._attr(attr).card_one
+
+    def _get(self, e, attr):
+        """The decoded values of attr for the encoded eid e, or None."""
+        return self._codes.decode_set(self._eav_index.get([e, self._codes.lookup(attr)]))
+
+    def _decode_entity(self, _entity):
+        decode = self._codes.decode
+        return {decode(a): self._codes.decode_set(vs) for a, vs in _entity.items()}
 
     def _assert_triple(self, triple):
-        e, a, v = triple
+        attr = self._attr(triple[1])
+        encode = self._codes.encode
+        fresh = len(self._codes)
+        e, a, v = encode(triple[0]), encode(triple[1]), encode(triple[2])
         # First if cardinality one, remove any other values
-        if self._card_one(a) and self._eav_index.get([e, a]):
-            for x in self._eav_index.get([e, a]).copy():
+        if attr.card_one:
+            for x in list(self._eav_index.get([e, a]) or []):
                 if x != v:
-                    self._retract_triple((e, a, x))
+                    self._remove_triple(e, a, x)
+        classify = bool(self._ref_classes)
+        if classify:
+            new_eids = self._new_eids([(e, v)], fresh)
+        if self._log_batch is not None:
+            self._log_batch.append((True,) + tuple(triple))
         # Add the canonical eav index
         self._eav_index.add([e, a, v])
         self._aev_index.add([a, e, v])
         # if it's a ref attribute, add a vae reference
-        if self._ref_attr(a):
+        if attr.ref:
             self._vae_index.add([v, a, e])
+        elif attr.indexed:
+            self._ave_index.add([a, v, e])
+        if attr.unique:
+            self._index_unique(e, a, v)
+        if classify:
+            self._classify_write([(a, [(e, v)])], new_eids)
+        if self._watch_all or a in self._watched:
+            self._attr_written(a)
+        if attr.attr in _DESCRIPTOR_META_ATTRS or attr.attr == 'db.cardinality:default':
+            self._schema_changed(triple)
         # And a lazy index of 
 
     def _retract_triple(self, triple):
-        e, a, v = triple
-        # Have to be careful here; remove only removes the first entry; Should just be using sets
+        e, a, v = [self._codes.lookup(x) for x in triple]
+        if e is not None and a is not None and v is not None:
+            self._remove_triple(e, a, v)
+
+    def _remove_triple(self, e, a, v):
+        """Retract the encoded triple from all the indexes."""
+        if self._log_batch is not None:
+            decode = self._codes.decode
+            self._log_batch.append((False, decode(e), decode(a), decode(v)))
         self._eav_index.remove([e, a, v])
         self._aev_index.remove([a, e, v])
-        reverse_index = self._vae_index.get([v])
-        if reverse_index:
-            reverse_attr_index = reverse_index.get([a])
-            if reverse_attr_index and e in reverse_attr_index:
-                reverse_attr_index.remove(e)
+        self._vae_index.remove([v, a, e])
+        self._ave_index.remove([a, v, e])
+        if self._ref_classes and not self._eav_index.contains([e]):
+            # that was the last of e
+            self._reclassify_eid(e, 'ref')
+        ids = self._unique_index.get(a)
+        if ids and ids.get(v) == e:
+            del ids[v]
+        if self._watch_all or a in self._watched:
+            self._attr_written(a)
+        attr = self._codes.decode(a)
+        if attr in _DESCRIPTOR_META_ATTRS or attr == 'db.cardinality:default':
+            decode = self._codes.decode
+            self._schema_changed((decode(e), attr, decode(v)))
+
+    def _delete_attr(self, attr, pairs):
+        """Retract the encoded (e, v) pairs for attr from every index; the counterpart of _insert_attr, for bulk
+        retraction. Pairs that aren't asserted are skipped. Returns the number of triples retracted."""
+        a = self._codes.lookup(attr)
+        if a is None:
+            return 0
+        if attr in _DESCRIPTOR_META_ATTRS or attr == 'db.cardinality:default':
+            # rare; let the one at a time path deal with the schema changes
+            contains = self._eav_index.contains
+            pairs = [(e, v) for e, v in set(pairs) if contains([e, a, v])]
+            for e, v in pairs:
+                self._remove_triple(e, a, v)
+            return len(pairs)
+        eav_remove, aev_remove = self._eav_index.remove, self._aev_index.remove
+        # (refs and value indexed attributes only need one of these, but the schema may have changed since)
+        vae_remove, ave_remove = self._vae_index.remove, self._ave_index.remove
+        ids = self._unique_index.get(a)
+        removed = []
+        for e, v in pairs:
+            if eav_remove([e, a, v]):
+                aev_remove([a, e, v])
+                vae_remove([v, a, e])
+                ave_remove([a, v, e])
+                if ids and ids.get(v) == e:
+                    del ids[v]
+                removed.append((e, v))
+        if not removed:
+            return 0
+        if self._log_batch is not None:
+            decode = self._codes.decode
+            self._log_batch.extend((False, decode(e), attr, decode(v)) for e, v in removed)
+        if self._ref_classes:
+            contains = self._eav_index.contains
+            for e in set(e for e, _ in removed if not contains([e])):
+                # entities gone
+                self._reclassify_eid(e, 'ref')
+        if self._watch_all or a in self._watched:
+            self._attr_written(a)
+        return len(removed)
 
     # Should the following two be public?
     def _assert_val(self, e, a, val, id_attrs=None, _ids=None):
@@ -456,29 +1303,31 @@ class TripleStore(object):
 
     def _resolve_eid(self, fact_dict, id_attrs=None, _ids=None):
         ident_val = some(fact_dict.get(self.ident_attr))
+        # `db:unique` attributes resolve through the persistent identity index; conflicts between them are
+        # picked up by _index_unique as the triples are asserted
+        eid = ident_val
+        if not eid and self._unique_index:
+            for a, ids in self._unique_index.items():
+                v = fact_dict.get(self._codes.decode(a))
+                if v is not None and not isinstance(v, (list, dict)):
+                    e = ids.get(self._codes.lookup(v))
+                    if e is not None:
+                        eid = self._codes.decode(e)
+                        break
+        id_attrs = [a for a in id_attrs or [] if a in fact_dict and not self._attr(a).unique]
         if id_attrs:
-            # This is not particularly efficient; should be using an aev or ave index
-            id_facts = {a: _ids[a].get(fact_dict[a]) or some(self.match({a: fact_dict[a]}))
-                        for a in id_attrs if a in fact_dict}
-            if ident_val:
-                # make sure no conflicting facts?
-                if any(id_facts.values()):
-                    warnings.warn("Warning! Conflicting values in _resolve_eid!")
-                eid = ident_val
-            else:
-                eids = set(v for v in id_facts.values() if v)
-                if eids:
-                    if len(eids) > 1:
-                        warnings.warn("Warning! Conflicting values in _resolve_eid (2)!")
-                    eid = some(eids)
-                else:
-                    eid = uuid.uuid1()
+            # Ad hoc id_attrs only hold for this transaction, so have to fall back on a match (a hash lookup if
+            # the attribute is `db:index`ed)
+            id_facts = {a: _ids[a].get(fact_dict[a]) or some(self.match({a: fact_dict[a]})) for a in id_attrs}
+            eids = set(v for v in id_facts.values() if v)
+            eid = eid or some(eids) or uuid.uuid1()
+            for a, other in id_facts.items():
+                if other and str(other) != str(eid):
+                    self._conflicts.append((a, fact_dict[a], str(eid), other))
             # Set the corresponding value in ids map for future
             for k in id_facts:
                 _ids[k][fact_dict[k]] = eid
-        else:
-            eid = ident_val or uuid.uuid1()
-        return str(eid)
+        return str(eid or uuid.uuid1())
 
     def _assert_dict(self, fact_dict, id_attrs=None, _ids=None):
         # Is it possible to middleware-factor local db:id vs global db:ident :vs native uuid or tuples?
@@ -499,6 +1348,60 @@ class TripleStore(object):
 
     # Our public API for asserting and retracting facts
 
+    def retract_fact(self, fact):
+        """Retract a fact, given as an eav triple, or as a dict of attribute values to retract from the entity
+        identified by its ident attr (single values or lists of them, as for assert_fact). Facts that aren't
+        asserted are ignored. Returns the number of triples retracted."""
+        return self.retract_facts([fact])
+
+    def retract_facts(self, facts):
+        """Retract a collection of facts as by retract_fact, grouped per attribute, so that each index and cache
+        is only visited once per attribute. Returns the number of triples retracted.
+
+        Retracted values keep their codes in the store's interner (so that anything still holding one stays
+        valid) until the next compact."""
+        lookup = self._codes.lookup
+        by_attr = collections.defaultdict(list)
+        for fact in facts:
+            if isinstance(fact, dict):
+                if self.ident_attr not in fact:
+                    raise ValueError('Facts to retract must have an {}: {}'.format(self.ident_attr, fact))
+                e = lookup(fact[self.ident_attr])
+                triples = ((None, a, v)
+                           for a, vs in fact.items() if a != self.ident_attr
+                           for v in (vs if isinstance(vs, (list, set, tuple)) else [vs]))
+            else:
+                e = lookup(fact[0])
+                triples = [fact]
+            if e is not None:
+                for _, a, v in triples:
+                    v = lookup(v.ident if type(v) is Entity else v)
+                    if v is not None:
+                        by_attr[a].append((e, v))
+        retracted = sum(self._delete_attr(a, pairs) for a, pairs in by_attr.items())
+        self._write_done()
+        return retracted
+
+    def retract_entity(self, eid):
+        """Retract everything about the entity eid, along with every ref to it (from ref attributes, and lazy
+        refs that have been reverse looked up). Returns the number of triples retracted. As with retract_facts,
+        the memory of the codes it leaves unused is only reclaimed by compact."""
+        e = self._codes.lookup(eid.ident if isinstance(eid, Entity) else eid)
+        by_attr = collections.defaultdict(list)
+        for a, v in self._eav_index.get([e]) or ():
+            by_attr[a].append((e, v))
+        for a, referrer in self._vae_index.get([e]) or ():
+            by_attr[a].append((referrer, e))
+        for attr in self._lazy_ref_attrs:
+            a = self._codes.lookup(attr)
+            referrers = self._ave_index.get([a, e])
+            if referrers:
+                by_attr[a].extend((referrer, e) for referrer in referrers)
+        decode = self._codes.decode
+        retracted = sum(self._delete_attr(decode(a), pairs) for a, pairs in by_attr.items())
+        self._write_done()
+        return retracted
+
     def assert_fact(self, fact, id_attrs=None, _ids=None):
         """Assert fact about an entity as a dict or as a single eav triple. Dictionaries are interpretted as
          a set of eav triples where e is a unique identitier for the entity (uuid, globally namespaced keyword,
@@ -508,54 +1411,555 @@ class TripleStore(object):
          attributes.  Identity attr can be set on graph instantiation."""
         if isinstance(fact, dict):
             # Returns eid
-            return self._assert_dict(fact, id_attrs=id_attrs, _ids=_ids)
+            eid = self._assert_dict(fact, id_attrs=id_attrs, _ids=_ids or collections.defaultdict(dict))
+            if _ids is None:
+                self._write_done()
+            return eid
         else:
             self._assert_triple(fact)
+            if _ids is None:
+                self._write_done()
 
-    def assert_facts(self, facts, id_attrs=None, _ids=None):
+    def assert_facts(self, facts, id_attrs=None, _ids=None, bulk=False):
         """As with assert_fact, except asserts either a collection of facts via assert_fact, or if passed a
         dictionary, interprets as a eav index to merge in. If passed in another TripleStore, interprets as
-        it's eav index, thereby merging the graphs :-)"""
+        it's eav index, thereby merging the graphs :-)
+
+        Identity conflicts are collected over the whole call and issued as a single IdentityConflictWarning.
+
+        With `bulk=True` the facts are asserted as a single transaction (see `transaction`): all documents are
+        flattened to triples first, identities are resolved in one pass, and the triples are then inserted per
+        attribute, settling cardinality one conflicts once per (e, a). Schema facts in the batch take effect
+        before any of the data. Returns a report dict with counts of `facts`, `entities` (dicts flattened),
+        `new_entities`, `triples` (inserted), `retracted` (cardinality one overwrites) and `conflicts`, along
+        with the `eids` of the top level fact dicts."""
+        if bulk:
+            tx = Transaction(id_attrs)
+            tx.assert_facts(facts)
+            return self._transact(tx)
+        top_level = _ids is None
+        _ids = _ids or collections.defaultdict(dict)
         if isinstance(facts, dict):
             # Then merge as an eav index of values
             for e, d in facts.items():
                 for a, vs in d.items():
                     for v in vs:
                         # May be more lookup time than if we look up and remember the nested dicts as we go
-                        self.assert_fact((e, a, v))
+                        self.assert_fact((e, a, v), _ids=_ids)
         elif isinstance(facts, TripleStore):
             # TODO; think about what id_attrs might mean here
             # Mmmm... need to update? use to_dict if needed...
-            self.assert_facts(facts._eav_index)
+            self.assert_facts(facts.triples(), _ids=_ids)
         else:
-            _ids = _ids or collections.defaultdict(dict)
             for fact in facts:
                 self.assert_fact(fact, id_attrs=id_attrs, _ids=_ids)
+        if top_level:
+            self._write_done()
+
+    @contextlib.contextmanager
+    def transaction(self, id_attrs=None):
+        """Context manager collecting facts (via the yielded Transaction's assert_fact/assert_facts) and
+        asserting them in bulk as by `assert_facts(..., bulk=True)` when the block exits. Nothing is asserted
+        if the block raises.
+
+            with store.transaction(id_attrs=['cft.seq:id']) as tx:
+                for doc in docs:
+                    tx.assert_fact(doc)
+            print(tx.report)
+        """
+        tx = Transaction(id_attrs)
+        yield tx
+        tx.report = self._transact(tx)
+
+    def _transact(self, tx):
+        # 1. Flatten all documents to triples, with _TempIds standing in for eids of the dicts
+        triples = []
+        entities = []
+        eids = []
+        for fact in tx.facts:
+            if isinstance(fact, dict):
+                eids.append(self._flatten_dict(fact, triples, entities))
+            else:
+                triples.append(tuple(fact))
+        # 2. Resolve identities in one pass
+        resolved, new_entities = self._resolve_tempids(entities, tx.id_attrs)
+        # 3. Insert, grouped per attribute; schema first, through the normal path, since it changes how
+        # everything else gets indexed
+        encode = self._codes.encode
+        by_attr = collections.defaultdict(list)
+        for e, a, v in triples:
+            if type(e) is _TempId:
+                e = resolved[e.index]
+            if type(v) is _TempId:
+                v = resolved[v.index]
+            if a in _DESCRIPTOR_META_ATTRS or a == 'db.cardinality:default':
+                self._assert_triple((e, a, v))
+            else:
+                by_attr[a].append((e, v))
+        fresh = len(self._codes)
+        groups = []
+        for a in sorted(by_attr, key=str):
+            # (in the same order as inserting one attribute at a time would)
+            encode(a)
+            groups.append((a, [(encode(e), encode(v)) for e, v in by_attr[a]]))
+        n_triples, retracted = self._insert_groups(groups, fresh)
+        n_triples += len(triples) - sum(len(pairs) for pairs in by_attr.values())
+        n_conflicts = len(self._conflicts)
+        self._write_done()
+        return {'facts': len(tx.facts),
+                'entities': len(entities),
+                'new_entities': new_entities,
+                'triples': n_triples,
+                'retracted': retracted,
+                'conflicts': n_conflicts,
+                'eids': [resolved[t.index] for t in eids]}
+
+    def _flatten_dict(self, fact_dict, triples, entities):
+        tempid = _TempId(len(entities))
+        entities.append(fact_dict)
+        for a, v in fact_dict.items():
+            for val in (v if isinstance(v, list) else [v]):
+                if isinstance(val, dict):
+                    val = self._flatten_dict(val, triples, entities)
+                triples.append((tempid, a, val))
+        if not fact_dict.get(self.ident_attr):
+            triples.append((tempid, self.ident_attr, tempid))
+        return tempid
+
+    def _resolve_tempids(self, entities, id_attrs=None):
+        """Resolve the eids for the flattened entity dicts of a bulk transaction, in order. As with _resolve_eid,
+        but entities earlier in the batch are also found through their `db:unique` and id_attrs values."""
+        decode = self._codes.decode
+        unique_attrs = [(decode(a), ids) for a, ids in self._unique_index.items()]
+        id_attrs = [(a, self._id_map(a)) for a in id_attrs or [] if not self._attr(a).unique]
+        _ids = collections.defaultdict(dict)
+        resolved = []
+        new_entities = 0
+        for fact_dict in entities:
+            found = []
+            for a, ids in unique_attrs:
+                v = fact_dict.get(a)
+                if v is not None and not isinstance(v, (list, dict)):
+                    other = _ids[a].get(v)
+                    if other is None:
+                        other = ids.get(self._codes.lookup(v))
+                        other = None if other is None else decode(other)
+                    found.append((a, v, other, True))
+            for a, ids in id_attrs:
+                v = fact_dict.get(a)
+                if v is not None and not isinstance(v, (list, dict)):
+                    other = _ids[a].get(v)
+                    if other is None:
+                        other = ids.get(self._codes.lookup(v))
+                        other = None if other is None else decode(other)
+                    found.append((a, v, other, False))
+            eid = some(fact_dict.get(self.ident_attr)) or some([other for _, _, other, _ in found if other])
+            if not eid:
+                eid = uuid.uuid1()
+                new_entities += 1
+            eid = str(eid)
+            for a, v, other, unique in found:
+                # Conflicts on unique attributes get picked up by _index_unique on insert
+                if other and other != eid and not unique:
+                    self._conflicts.append((a, v, eid, other))
+                _ids[a][v] = eid
+            resolved.append(eid)
+        return resolved, new_entities
+
+    def _id_map(self, attr):
+        """An encoded {value: eid} map of the (non `db:unique`) attr, for resolving identities by it in bulk;
+        one pass over its AVE entries if it's indexed, or its AEV ones if not. Where several entities share a
+        value, any one of them will do, as for match."""
+        a = self._codes.lookup(attr)
+        if a is None:
+            return {}
+        if self._attr(attr).indexed:
+            return {v: next(iter(es)) for v, es in (self._ave_index.get([a]) or _SubIndex({})).items()}
+        return {v: e for e, v in self._aev_index.get([a]) or ()}
+
+    def _insert_groups(self, groups, fresh):
+        """_insert_attr each of the (attr, encoded pairs) groups, then update _ref_classes for all of them, given
+        the interner's length fresh from before the pairs were encoded. Returns the total counts."""
+        classify = bool(self._ref_classes)
+        if classify:
+            new_eids = self._new_eids((pair for _, pairs in groups for pair in pairs), fresh)
+        inserted = retracted = 0
+        for attr, pairs in groups:
+            inserted_, retracted_ = self._insert_attr(attr, pairs)
+            inserted += inserted_
+            retracted += retracted_
+        if classify:
+            lookup = self._codes.lookup
+            self._classify_write([(lookup(attr), pairs) for attr, pairs in groups], new_eids)
+        return inserted, retracted
+
+    def _insert_attr(self, attr, pairs):
+        """Insert the encoded (e, v) pairs for attr into every index. Returns the number of triples inserted,
+        and the number retracted to keep cardinality one. Callers update _ref_classes (see _classify_write) once
+        all of their attributes are in."""
+        descriptor = self._attr(attr)
+        a = self._codes.encode(attr)
+        retracted = 0
+        if descriptor.card_one:
+            # last one wins, as it would asserting one at a time
+            pairs = list(dict(pairs).items())
+            eav_get = self._eav_index.get
+            for e, v in pairs:
+                for x in list(eav_get([e, a]) or []):
+                    if x != v:
+                        self._remove_triple(e, a, x)
+                        retracted += 1
+        if self._log_batch is not None:
+            decode = self._codes.decode
+            self._log_batch.extend((True, decode(e), attr, decode(v)) for e, v in pairs)
+        eav_add = self._eav_index.add
+        for e, v in pairs:
+            eav_add((e, a, v))
+        self._aev_index.add_group(a, pairs)
+        if descriptor.ref:
+            vae_add = self._vae_index.add
+            for e, v in pairs:
+                vae_add((v, a, e))
+        elif descriptor.indexed:
+            self._ave_index.add_group(a, ((v, e) for e, v in pairs))
+        if descriptor.unique:
+            for e, v in pairs:
+                self._index_unique(e, a, v)
+        if self._watch_all or a in self._watched:
+            self._attr_written(a)
+        return len(pairs), retracted
 
     # Should have this as a method as well, and just move the class method out as a simple fn
     @classmethod
-    def load(cls, filename, schema=None, id_attrs=None):  # add format option eventually?
-        """Load data from a JSON file, and assert as with assert_facts."""
+    def load(cls, filename, schema=None, id_attrs=None, stream=True, progress=None):
+        """Load data from a JSON file, and assert as with assert_facts. Unless stream is False, the file is read
+        incrementally via iter_json_facts, so only about one top level fact is in memory at a time; progress is
+        passed along to it. Binary snapshots (see dump) are detected by their magic line, and restored
+        directly, with schema and id_attrs applied on top."""
         with open(filename, 'rb') as fp:
-            data = json.load(fp)
+            if is_snapshot(fp):
+                return cls._load_snapshot(fp, schema=schema, id_attrs=id_attrs)
+            data = iter_json_facts(fp, progress=progress) if stream else json.load(fp)
             return cls(facts=data, schema=schema, id_attrs=id_attrs)
 
     @classmethod
-    def loads(cls, filenames, schema=None, id_attrs=None):
+    def _load_snapshot(cls, fp, schema=None, id_attrs=None):
+        header, state = _read_snapshot(fp)
+        store = cls(ident_attr=header['ident_attr'], index_values=header['index_values'],
+                    lazy_refs=header['lazy_refs'], default_cardinality=header['default_cardinality'])
+        store._codes = _Interner(state['codes'])
+        for name in ('eav', 'aev', 'vae', 'ave'):
+            index = TupleIndex()
+            index.keys = state[name]
+            setattr(store, '_{}_index'.format(name), index)
+        store._unique_index = state['unique']
+        store._lazy_ref_attrs = set(header.get('lazy_ref_attrs', ()))
+        store._log_generation = header.get('log_generation', 0)
+        store._attr_cache.clear()
+        if id_attrs:
+            store.assert_schema({a: {'db:unique': 'db.unique:identity'} for a in id_attrs})
+        if schema:
+            store.assert_schema(schema)
+        return store
+
+    @classmethod
+    def loads(cls, filenames, schema=None, id_attrs=None, stream=True, progress=None, processes=None):
         """Load data as with load_file, but reduces over facts from all filenames. Takes the schema from the
         first file as default for the global defaults schema parameters. Per attribute schema should absorb
-        from each though."""
-        result = cls.load(filenames[0], schema=schema, id_attrs=id_attrs)
+        from each though.
+
+        With processes > 1, every file after the first is parsed and indexed in a pool of worker processes,
+        and the resulting indexes are merged in (in file order) as by `merge`, rather than re-asserting each
+        triple. id_attrs are declared unique, so entities still resolve across files."""
+        result = cls.load(filenames[0], schema=schema, id_attrs=id_attrs, stream=stream, progress=progress)
+        if processes and processes > 1 and len(filenames) > 2:
+            shard_args = [(cls, filename, result._schema_dict(), id_attrs, result.default_cardinality,
+                           result.lazy_refs, stream)
+                          for filename in filenames[1:]]
+            pool = multiprocessing.Pool(processes=processes)
+            try:
+                for values, aev in pool.imap(_load_shard, shard_args):
+                    result._merge_encoded(values, aev)
+            finally:
+                pool.close()
+                pool.join()
+            return result
         for filename in filenames[1:]:
             with open(filename, 'rb') as fp:
-                data = json.load(fp)
+                if is_snapshot(fp):
+                    _, state = _read_snapshot(fp)
+                    result._merge_encoded(state['codes'], state['aev'])
+                    continue
+                data = iter_json_facts(fp, progress=progress) if stream else json.load(fp)
                 result.assert_facts(data, id_attrs=id_attrs)
         return result
 
-    def dump(self, filename):
-        """Save semantic graph to a json file as an EAV index."""
+    def _schema_dict(self):
+        """The per attribute schema, in the `{attr: {meta_attr: value}}` form taken by assert_schema."""
+        ident_attr = self.ident_attr
+        return {some(attr_schema[ident_attr]): {k: some(v) for k, v in attr_schema.items() if k != ident_attr}
+                for attr_schema in self.schema() if attr_schema.get(ident_attr)}
+
+    def merge(self, other):
+        """Merge another TripleStore into this one as an index level union, without re-running the assert
+        pipeline. Entities of other which share a `db:unique` value with one of ours are merged into ours;
+        cardinality one attributes take other's values."""
+        self._merge_encoded(other._codes.values, other._aev_index.keys)
+
+    def _merge_encoded(self, values, aev):
+        # values is the other store's code table, and aev its raw AEV index; translate its codes to ours
+        encode = self._codes.encode
+        fresh = len(self._codes)
+        remap = [encode(v) for v in values]
+        # Entities known by one of our unique identity values become ours
+        for a, sub in aev.items():
+            ids = self._unique_index.get(remap[a])
+            if ids:
+                for e, v in _SubIndex(sub):
+                    ours = ids.get(remap[v])
+                    if ours is not None and ours != remap[e]:
+                        remap[e] = ours
+        # Schema first, through the normal path, then everything else per attribute as in a bulk transaction
+        decode = self._codes.decode
+        data = []
+        for a, sub in aev.items():
+            attr = values[a]
+            pairs = [(remap[e], remap[v]) for e, v in _SubIndex(sub)]
+            if attr in _DESCRIPTOR_META_ATTRS or attr == 'db.cardinality:default':
+                for e, v in pairs:
+                    self._assert_triple((decode(e), attr, decode(v)))
+            else:
+                data.append((attr, pairs))
+        self._insert_groups(sorted(data, key=lambda x: str(x[0])), fresh)
+        self._write_done()
+
+    def index_stats(self):
+        """Report the approximate memory cost of each index in bytes, as by TupleIndex.sizeof, keyed by index
+        name. The `ave` entry is the price paid for `db:index` attributes."""
+        return {'eav': self._eav_index.sizeof(),
+                'aev': self._aev_index.sizeof(),
+                'vae': self._vae_index.sizeof(),
+                'ave': self._ave_index.sizeof(),
+                'codes': self._codes.sizeof()}
+
+    def dump(self, filename, format='json'):
+        """Save semantic graph to a json file as an EAV index. With `format='snapshot'`, write a binary snapshot
+        of the built indexes instead, which load restores without re-asserting anything. With
+        `format='columnar'`, write a file for tripl.columnar.MappedTripleStore."""
+        if format == 'snapshot':
+            return self._dump_snapshot(filename)
+        elif format == 'columnar':
+            from tripl import columnar
+            return columnar.write(self, filename)
+        elif format != 'json':
+            raise ValueError('Unknown dump format: {}'.format(format))
+        decode = self._codes.decode
         with open(filename, 'w') as fp:
-            json.dump(self._eav_index.to_dict(), fp, default=list)
+            json.dump({decode(e): self._decode_entity(self._eav_index.get([e]))
+                       for e in self._eav_index.iterkeys()},
+                      fp, default=list)
+
+    def _dump_snapshot(self, filename):
+        header = {'version': SNAPSHOT_VERSION,
+                  'ident_attr': self.ident_attr,
+                  'index_values': self._index_values,
+                  'lazy_ref_attrs': sorted(self._lazy_ref_attrs),
+                  'log_generation': self._log_generation,
+                  'lazy_refs': self.lazy_refs,
+                  'default_cardinality': self.default_cardinality}
+        state = {'codes': self._codes.values,
+                 'eav': self._eav_index.keys,
+                 'aev': self._aev_index.keys,
+                 'vae': self._vae_index.keys,
+                 'ave': self._ave_index.keys,
+                 'unique': self._unique_index}
+        with open(filename, 'wb') as fp:
+            fp.write(SNAPSHOT_MAGIC)
+            pickle.dump(header, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Persistence: a snapshot plus an append only log of the writes since
+
+    @classmethod
+    def open(cls, filename, log=None, sync=True, compact_at=None, **kwargs):
+        """Open the store persisted at filename, creating it (with kwargs, as for the constructor) if it doesn't
+        exist. If it does, kwargs (but for facts, which are only for creating it) are applied to it as it's
+        opened: schema is asserted, new settings stick, and index_values can turn on but not off. It's kept as
+        a snapshot (see dump) of everything up to the last compaction, and an append only
+        log (at log, by default filename + '.log') of the writes since, which is replayed over it here.
+
+        From then on, each write call (assert_fact, assert_facts, transactions, merge) appends one record of
+        the triples it asserted and retracted to the log, flushed (and with sync, fsynced) before returning.
+        After a crash, opening again recovers everything up to the last complete call. compact folds the log
+        into a new snapshot, as happens by itself once the log grows past compact_at bytes."""
+        log = log or filename + '.log'
+        exists = os.path.exists(filename)
+        if exists:
+            with open(filename, 'rb') as fp:
+                store = cls._load_snapshot(fp)
+        else:
+            store = cls(**kwargs)
+        store._snapshot_path = filename
+        store._log_sync = sync
+        store._compact_at = compact_at
+        end = store._replay_log(log) if os.path.exists(log) else None
+        store._log = open(log, 'r+b' if end else 'w+b')
+        store._log_batch = []
+        if end:
+            # drop anything torn off the end by a crash, and carry on after it
+            store._log.truncate(end)
+            store._log.seek(end)
+        else:
+            store._reset_log()
+        try:
+            # so that the constructor arguments stick
+            if not exists or store._reconfigure(**kwargs):
+                store.compact()
+        except Exception:
+            store.close()
+            raise
+        return store
+
+    def _reconfigure(self, schema=None, facts=None, lazy_refs=None, default_cardinality=None, types=None,
+                     ident_attr=None, id_attrs=None, index_values=False, match_cache_size=None):
+        """Apply the constructor arguments to a store open loaded from its snapshot (and log). Returns whether
+        any of the settings kept in the snapshot header changed, in which case it needs compacting for them to
+        stick; schema and id_attrs are asserted, and so logged, like any other write."""
+        if facts:
+            raise ValueError("facts are only for creating a store; assert them once it's open")
+        if ident_attr is not None and ident_attr != self.ident_attr:
+            raise ValueError("Store was created with ident_attr {!r}, not {!r}".format(self.ident_attr, ident_attr))
+        if id_attrs:
+            self.assert_schema({a: {'db:unique': 'db.unique:identity'} for a in id_attrs})
+        if schema:
+            self.assert_schema(schema)
+        self.match_cache_size = match_cache_size
+        if types is not None:
+            self.types = types
+        changed = False
+        if index_values and not self._index_values:
+            self._index_values = changed = True
+            self._attr_cache.clear()
+            for a in list(self._aev_index.iterkeys()):
+                self._reindex_values(self._codes.decode(a))
+        settings = {}
+        if lazy_refs is not None and lazy_refs != self.lazy_refs:
+            self.lazy_refs = settings['db.refs:lazy'] = lazy_refs
+        if default_cardinality is not None and default_cardinality != self.default_cardinality:
+            self.default_cardinality = settings['db.cardinality:default'] = default_cardinality
+        if settings:
+            settings[self.ident_attr] = 'db:schema'
+            self.assert_fact(settings)
+            changed = True
+        return changed
+
+    def _replay_log(self, log):
+        """Replay the log over the store, returning the offset of the end of its last good record, or None if
+        it's from before the snapshot (so already in it)."""
+        with open(log, 'rb') as fp:
+            if fp.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError('Not a tripl log: {}'.format(log))
+            records = _read_log_records(fp)
+            header, end = next(records, (None, None))
+            if header is None or header['generation'] != self._log_generation:
+                return None
+            if header['version'] != LOG_VERSION:
+                raise ValueError('Unsupported tripl log version {} (expected {})'.format(header['version'],
+                                                                                        LOG_VERSION))
+            for batch, end in records:
+                for op in batch:
+                    if op[0]:
+                        self._assert_triple(op[1:])
+                    else:
+                        self._retract_triple(op[1:])
+            self._report_conflicts()
+            return end
+
+    def _reset_log(self):
+        fp = self._log
+        fp.seek(0)
+        fp.truncate()
+        fp.write(LOG_MAGIC)
+        _write_log_record(fp, {'version': LOG_VERSION, 'generation': self._log_generation})
+        fp.flush()
+        if self._log_sync:
+            os.fsync(fp.fileno())
+
+    def _flush_log(self):
+        fp = self._log
+        batch, self._log_batch = self._log_batch, []
+        _write_log_record(fp, batch)
+        fp.flush()
+        if self._log_sync:
+            os.fsync(fp.fileno())
+        if self._compact_at and fp.tell() > self._compact_at:
+            self.compact()
+
+    def compact(self):
+        """Reclaim the codes of everything retracted (see _compact_codes), and for a store from open, fold its
+        log into a new snapshot, and start the log over. The new snapshot is written alongside and renamed into
+        place, so a crash part way through loses nothing."""
+        if self._log_batch:
+            self._flush_log()
+        self._compact_codes()
+        if self._log is None:
+            return
+        self._log_generation += 1
+        tmp = self._snapshot_path + '.tmp'
+        self._dump_snapshot(tmp)
+        if self._log_sync:
+            with open(tmp, 'rb') as fp:
+                os.fsync(fp.fileno())
+        os.replace(tmp, self._snapshot_path)
+        # the log is now out of date by generation, until it's reset
+        self._reset_log()
+
+    def _compact_codes(self):
+        """Encode everything over again with just the codes still in use. The interner never forgets a value by
+        itself, so without this, the codes of retracted values pile up in long lived stores. Codes keep their
+        order. Whatever derived state holds codes is remapped or dropped, and plans compiled before are compiled
+        again when next used."""
+        live = set()
+        for e, sub in self._eav_index.keys.items():
+            live.add(e)
+            for a, vals in sub.items():
+                live.add(a)
+                if type(vals) is set:
+                    live.update(vals)
+                else:
+                    live.add(vals)
+        if len(live) == len(self._codes):
+            return
+        values = self._codes.values
+        order = sorted(live)
+        remap = {code: new for new, code in enumerate(order)}
+        self._codes = _Interner([values[code] for code in order])
+        for index in (self._eav_index, self._aev_index, self._vae_index, self._ave_index):
+            index.keys = {remap[k1]: {remap[k2]: set(remap[v] for v in vals) if type(vals) is set else remap[vals]
+                                      for k2, vals in sub.items()}
+                          for k1, sub in index.keys.items()}
+        self._unique_index = {remap[a]: {remap[v]: remap[e] for v, e in ids.items()}
+                              for a, ids in self._unique_index.items() if a in remap}
+        self._ref_classes = {remap[a]: cls for a, cls in self._ref_classes.items() if a in remap}
+        self._sorted_indexes.clear()
+        if self._match_cache is not None:
+            self._match_cache.entries.clear()
+            self._match_cache.by_attr.clear()
+        for plan in list(self._pull_memos):
+            plan.memo.clear()
+        self._pull_memos = weakref.WeakSet()
+        self._watched = set()
+        self._watch_all = False
+        for entity in list(self._entity_map.values()):
+            entity._code = None
+
+    def close(self):
+        """Stop logging the writes of a store from open, and close its log."""
+        if self._log is not None:
+            if self._log_batch:
+                self._flush_log()
+            self._log.close()
+            self._log = self._log_batch = None
 
     # # Now our query engine
     # We have a few different kind of queries we want to be able to execute
@@ -583,30 +1987,237 @@ class TripleStore(object):
     #  'sort': 'db:ident',
     # }
     # Could in memory be evaluated via a local DataScript JS server via https://pypi.python.org/pypi/PyExecJS
+    # (This is what `q` below implements, with `sort` naming find variables; see _run_query.)
+
+    def q(self, query):
+        """Run a Datalog query in the grammar above, returning a list of the distinct tuples of values of the
+        `find` variables. Where clauses are `[e, attr, v]` triples, where e and v may be `?variables` or
+        constants (attr has to be a constant), or rule calls, `[rule_name, arg, ...]`. Optionally:
+
+        * `rules`: a list of `[[rule_name, ?var, ...], clause, ...]` rule definitions; several with the same name
+          are alternatives
+        * `sort`: a find variable or list of them to sort the results by (descending with `sort_desc: True`)
+        * `take`: the number of results to return
+
+        Clauses are joined cheapest first, using index lookups where a variable is already bound, and hash joins
+        otherwise; results stream out of the joins, so take (with or without sort) never holds more than it
+        needs."""
+        return _run_query(self, query)
 
     # Going to start for now with the simple pull and match queries
 
     def _entity_lookup(self, lookup):
-        attr, val = lookup
-        if self._ref_attr(attr):
-            return self._vae_index.get([val, attr], set())
+        # Everything here is encoded; lookup is (attr, value codes), and we return a set of eid codes
+        attr, lookup_vals = lookup
+        if not lookup_vals:
+            return set()
+        attr = self._attr(attr)
+        a = self._codes.lookup(attr.attr)
+        if attr.ref or attr.indexed:
+            # Straight hash lookups on the vae (refs) or ave (indexed values) index
+            if attr.ref:
+                matches = (self._vae_index.get([v, a]) for v in lookup_vals)
+            else:
+                matches = (self._ave_index.get([a, v]) for v in lookup_vals)
+            return set(e for es in matches if es for e in es)
         else:
             # we look up the index, and see if the vals pointed to intersect with the lookup val for each key in
             # the pattern
-            lookup_vals = val if isinstance(val, (list, set)) else [val]
-            index_results = self._aev_index.get([attr])
+            index_results = self._aev_index.get([a])
             if index_results:
-                return set(eid for eid, vals in index_results.keys.items()
-                           if vals.intersection(lookup_vals))
+                lookup_vals = set(lookup_vals)
+                return set(eid for eid, v in index_results if v in lookup_vals)
+            else:
+                return set()
+
+    # Match planning: rather than evaluating every clause of a pattern in full and intersecting, clauses are
+    # ordered by an estimate of what they'd cost evaluated on their own, from the index sizes (which the indexes
+    # keep up to date for free). Only the first is evaluated in full; every later clause is just checked against
+    # the surviving eids, and we stop as soon as none are left. Nested patterns are likewise only matched
+    # against the entities the candidates point to.
+
+    def _clause_cost(self, attr, vals):
+        """Estimated number of eids the (attr, value codes) clause would look at, evaluated on its own."""
+        a = self._codes.lookup(attr)
+        if not vals or a is None:
+            return 0
+        descriptor = self._attr(attr)
+        if descriptor.ref:
+            return sum(self._vae_index.count([v, a]) for v in vals)
+        elif descriptor.indexed:
+            return sum(self._ave_index.count([a, v]) for v in vals)
+        # a scan of every entity with the attribute
+        return self._aev_index.count([a])
+
+    def _plan_match(self, pattern):
+        """Encode the pattern's values, and order its clauses cheapest first, as a _MatchPlan."""
+        clauses = []
+        for attr, v in pattern.items():
+            if _is_predicate(v):
+                vals = self._predicate_codes(attr, v)
+                cost = self._clause_cost(attr, vals)
+            elif isinstance(v, dict):
+                vals = self._plan_match(v)
+                cost = vals.cost
             else:
+                codes = map(self._codes.lookup, v if isinstance(v, (list, set)) else [v])
+                vals = [code for code in codes if code is not None]
+                cost = self._clause_cost(attr, vals)
+            clauses.append((cost, attr, vals))
+        clauses.sort(key=lambda clause: clause[0])
+        plan = _MatchPlan((attr, vals) for _, attr, vals in clauses)
+        plan.cost = clauses[0][0] if clauses else 0
+        return plan
+
+    def _match(self, pattern, candidates=None):
+        """As match, but returns encoded eids, optionally only from among the candidates."""
+        cache = self._match_cache
+        if cache is None or candidates is not None:
+            return self._match_plan(self._plan_match(pattern), candidates)
+        deps = set()
+        try:
+            key = self._match_key(pattern, deps)
+        except TypeError:
+            # unhashable values
+            return self._match_plan(self._plan_match(pattern))
+        eids = cache.get(key)
+        if eids is None:
+            eids = frozenset(self._match_plan(self._plan_match(pattern)))
+            # an attribute with no code yet can't be watched for writes, and matching on it is free anyway
+            if None not in deps:
+                cache.put(key, eids, deps)
+                self._watched.update(deps)
+        return eids
+
+    def _match_key(self, pattern, deps):
+        """A hashable key for pattern, the same for equivalent patterns (value order doesn't matter, and a single
+        value is the same as a list of just it), adding the codes of the attributes it mentions to deps."""
+        key = []
+        for attr, v in pattern.items():
+            deps.add(self._codes.lookup(attr))
+            if _is_predicate(v):
+                v = (_is_predicate, frozenset((op, _intern_key(bound)) for op, bound in v.items()))
+            elif isinstance(v, dict):
+                v = (dict, self._match_key(v, deps))
+            else:
+                v = frozenset(_intern_key(x) for x in (v if isinstance(v, (list, set)) else [v]))
+            key.append((attr, v))
+        return frozenset(key)
+
+    def _match_plan(self, plan, candidates=None):
+        result = candidates
+        for attr, vals in plan:
+            if not vals:
+                # no values to match (say they were never asserted); being free, this clause is first, so
+                # nothing gets scanned
                 return set()
+            if result is not None and not result:
+                break
+            if isinstance(vals, _MatchPlan):
+                if result is None:
+                    # have to start somewhere; match the nested pattern in full, and go back through the refs
+                    result = self._entity_lookup((attr, self._match_plan(vals)))
+                else:
+                    result = self._probe_nested(attr, vals, result)
+            elif result is None:
+                result = self._entity_lookup((attr, vals))
+            else:
+                result = self._probe(attr, vals, result)
+        return set() if result is None else result
+
+    def _predicate_codes(self, attr, predicate):
+        """The codes of the values of attr satisfying the predicate; by bisection if attr has a sorted value
+        index, and otherwise by checking each of its distinct values."""
+        a = self._codes.lookup(attr)
+        rank = _predicate_rank(predicate)
+        if a is None or rank is None:
+            return []
+        if self._attr(attr).sorted:
+            keys, codes = self._sorted_values(a)
+            lo = bisect.bisect_left(keys, (rank,))
+            hi = bisect.bisect_left(keys, (rank + 1,))
+            for op, bound in predicate.items():
+                if op == '>=':
+                    lo = max(lo, bisect.bisect_left(keys, (rank, bound)))
+                elif op == '>':
+                    lo = max(lo, bisect.bisect_right(keys, (rank, bound)))
+                elif op == '<=':
+                    hi = min(hi, bisect.bisect_right(keys, (rank, bound)))
+                elif op == '<':
+                    hi = min(hi, bisect.bisect_left(keys, (rank, bound)))
+                elif bound:
+                    # prefix; everything from the prefix up to (not including) its successor
+                    lo = max(lo, bisect.bisect_left(keys, (rank, bound)))
+                    if ord(bound[-1]) < sys.maxunicode:
+                        hi = min(hi, bisect.bisect_left(keys, (rank, bound[:-1] + chr(ord(bound[-1]) + 1))))
+            return codes[lo:hi]
+        if self._attr(attr).indexed:
+            distinct = self._ave_index.get([a]) or _SubIndex({})
+            distinct = distinct.iterkeys()
+        else:
+            distinct = set(v for _, v in self._aev_index.get([a], ()))
+        decode = self._codes.decode
+        tests = [(_PREDICATES[op], bound) for op, bound in predicate.items()]
+        codes = []
+        for code in distinct:
+            x = decode(code)
+            if _sort_rank(x) == rank and all(test(x, bound) for test, bound in tests):
+                codes.append(code)
+        return codes
+
+    def _sorted_values(self, a):
+        """The sorted value index of the attribute with code a, as (keys, codes): the sorted (_sort_rank, value)
+        keys of its distinct number and string values, and their codes. Built from AVE when first needed, and
+        dropped on writes to the attribute."""
+        entry = self._sorted_indexes.get(a)
+        if entry is None:
+            decode = self._codes.decode
+            items = []
+            for code in (self._ave_index.get([a]) or _SubIndex({})).iterkeys():
+                x = decode(code)
+                rank = _sort_rank(x)
+                if rank is not None:
+                    items.append(((rank, x), code))
+            items.sort(key=lambda item: item[0])
+            entry = self._sorted_indexes[a] = ([key for key, _ in items], [code for _, code in items])
+            self._watched.add(a)
+        return entry
+
+    def _probe(self, attr, vals, candidates):
+        """The eids among candidates with any of the value codes vals for attr."""
+        a = self._codes.lookup(attr)
+        if len(vals) == 1:
+            contains = self._eav_index.contains
+            v = vals[0]
+            return set(e for e in candidates if contains([e, a, v]))
+        get = self._eav_index.get
+        vals = set(vals)
+        return set(e for e in candidates if not vals.isdisjoint(get([e, a], ())))
+
+    def _probe_nested(self, attr, plan, candidates):
+        """The eids among candidates pointing through attr to an entity matching the nested plan."""
+        a = self._codes.lookup(attr)
+        get = self._eav_index.get
+        targets = {}
+        for e in candidates:
+            vs = get([e, a])
+            if vs:
+                targets[e] = vs
+        if not targets:
+            return set()
+        matching = self._match_plan(plan, set().union(*targets.values()))
+        return set(e for e, vs in targets.items() if not matching.isdisjoint(vs))
 
     def match(self, pattern):
-        def xf_subpattern(v):
-            return self.match(v) if isinstance(v, dict) else v
+        """The eids of the entities matching pattern, a dict of attributes to values, where values can be:
 
-        pattern = {k: xf_subpattern(v) for k, v in pattern.items()}
-        return functools.reduce(set.intersection, map(self._entity_lookup, pattern.items()))
+        * a value, or list or set of alternatives
+        * a nested pattern, matched by the entities the attribute refers to
+        * a predicate dict, of one or more of `<`, `<=`, `>`, `>=` (number or string bounds) and `prefix`, e.g.
+          `{'bio.seq:length': {'>=': 1000, '<': 2000}}`. Attributes with `db:index db.index:sorted` in their
+          schema answer these by bisecting a sorted index of their values; others check every distinct value.
+        """
+        return self._codes.decode_set(self._match(pattern))
 
     # Should probably rename just match, instead of match pattern; then can do match_some for get first?
     def match_pattern(self, pattern):
@@ -624,6 +2235,57 @@ class TripleStore(object):
     def entities(self, pattern, namespace=None):
         return [self.entity(some(ident), namespace=namespace) for ident in self.match(pattern)]
 
+    def compile_pull(self, pull_expr, memoize=False):
+        """Compile pull_expr (see pull) into a plan, with its attributes' codes, descriptors and reverse lookup
+        indexes all resolved up front, rather than for every entity pulled. pull and pull_many compile their
+        pull expressions anyway, but also take a compiled plan, which is worth reusing when pulling lots of
+        entities a bit at a time. Compile again after changing the schema.
+
+        Nested (non recursive) sub documents are pulled once per referenced entity and shared by everything
+        referencing it, for the length of a pull or pull_many call; with memoize, for as long as the plan is
+        kept, until there's a write to any attribute they depend on. Either way, copy results before modifying
+        them."""
+        if isinstance(pull_expr, _PullPlan) and pull_expr.store is self and pull_expr.codes is self._codes:
+            if not pull_expr.memoize:
+                # a fresh memo for each call
+                for plan in pull_expr.memoized:
+                    plan.memo.clear()
+            return pull_expr
+        plan = self._compile_pull(getattr(pull_expr, 'expr', pull_expr))
+        plan.memoize = memoize or getattr(pull_expr, 'memoize', False)
+        return plan
+
+    def _compile_pull(self, pull_expr, base=None):
+        plan = _PullPlan(self, pull_expr)
+        plan.base = base = base or plan
+        codes = self._codes
+        for x in pull_expr:
+            if isinstance(x, dict):
+                for attr, token in x.items():
+                    if token == '...':
+                        sub = None
+                    else:
+                        sub = self._compile_pull([token] if isinstance(token, str) else token, base)
+                    plan.links.append((attr, self._link(attr), sub, self._attr(attr).card_one))
+            elif x == '*':
+                plan.star = True
+            elif self._attr(x).reverse:
+                # pulls as the idents of the entities pointing at us
+                plan.links.append((x, self._link(x), self._compile_pull([self.ident_attr], base), False))
+            else:
+                plan.attrs.append((x, codes.lookup(x), self._attr(x).card_one))
+        plan.recursive = [link for link in plan.links if link[2] is None]
+        plan.closed = all(sub is not None and sub.closed for _, _, sub, _ in plan.links)
+        if plan.closed and base is not plan:
+            deps = set(a for _, a, _ in plan.attrs) | set(a for _, (_, a), _, _ in plan.links)
+            subs = [sub.deps for _, _, sub, _ in plan.links]
+            if not plan.star and None not in deps and None not in subs:
+                # (an attribute with no code yet could still be written; it's simplest to watch everything)
+                plan.deps = deps.union(*subs)
+            plan.memo = {}
+            base.memoized.append(plan)
+        return plan
+
     def pull(self, pull_expr, entity,
              _seen_entities=None, _base_pattern=None):
         """
@@ -648,97 +2310,654 @@ class TripleStore(object):
           * `'*'` is a wildcard that can be used to catch all attributes of the matched locations
           * `_` after the `:` separator of the namespaced `university:_location` attribute specifies a reverse
             lookup on the attribute `university:location` of the university entities.
+          * may also be a plan from compile_pull
         """
-        # XXX Note: note currently processing _seen_entities correctly here for termination of recursion
-        # points in pull expressions
-        # set base pattern if necessary
-        _base_pattern = _base_pattern or pull_expr
-        _seen_entities = _seen_entities or set()
-        _base_pattern = _base_pattern or pull_expr
+        if _base_pattern is not None and _base_pattern is not pull_expr:
+            # '...' in pull_expr recurses into _base_pattern rather than pull_expr itself
+            base = self._compile_pull(_base_pattern)
+            plan = base if pull_expr is _base_pattern else self._compile_pull(pull_expr, base)
+        else:
+            plan = self.compile_pull(pull_expr)
+        _seen_entities = frozenset(_seen_entities or ())
         if isinstance(entity, dict):
-            eids = self.match(entity)
             # This should only be getting called on top level entity in the tree, so don't really need
             # _base_pattern or even _seen_entities in theory
-            return self.pull(pull_expr, some(eids), _seen_entities=_seen_entities)
+            eid = some(self._match(entity))
         else:
-            eid = entity.eid if isinstance(entity, Entity) else entity
-            if eid in _seen_entities:
-                # short circuit and just return the eid
-                # this should really not be a set once we get schema properly returning just the one ident
-                return {'db:ident': set(eid)}
-            # otherwise add this eid to the list of now seen eids
-            _seen_entities.add(eid)
-            _entity = self._eav_index.get([eid])
-            dict_patterns = filter(lambda x: isinstance(x, dict), pull_expr)
-            attr_patterns = filter(lambda x: not (isinstance(x, dict)), pull_expr)
-            # Get the attr_patterns (non recursive patterns), separate reverse lookups, etc
-            # QUESTION Do we want to return an id dictionary when we know it's a ref? who should we copy?
-            normal_attributes = filter(lambda x: x not in {'*'} and not reverse_lookup(x), attr_patterns)
-            reverse_lookups = filter(reverse_lookup, attr_patterns)
-            pull_data = {attr: _entity.get([attr]) for attr in normal_attributes}
-            # Handling reverse lookups at base attr_patterns (not in the dict_patterns)
-            if reverse_lookups:
-                for lookup in reverse_lookups:
-                    pull_data[lookup] = self.pull([{lookup: [self.ident_attr]}], eid)[lookup]
-            # Handle * attrs
-            if '*' in attr_patterns:
-                for a, vs in _entity.keys.items():
-                    if a not in pull_data:
-                        pull_data[a] = vs  # cardinality schema?
-            # Deal with the dict patterns, which correspond with relations/refs (implicit are fine; though
-            # need to think about the details of how defaults and options work out)
-            for dict_pattern in dict_patterns:
-                for attr, token in dict_pattern.items():
-                    reverse = reverse_lookup(attr)
-                    eids = None
-                    if reverse:
-                        # Then reverse lookup
-                        if self._ref_attr(reverse):
-                            # Can do this; have reverse mapping indexed (vae)
-                            eids = self._vae_index.get([eid, reverse])
-                        elif self.lazy_refs:
-                            # have to search through all triples
-                            reversed_lookup = self._aev_index.get([reverse])
-                            eids = set(
-                                (e for e, vs in reversed_lookup.keys.items() if eid in vs) if reversed_lookup else [])
-                        else:
-                            warnings.warn("Warning! Should have either lazy refs or or a schema for reverse lookups!")
-                    else:
-                        eids = _entity.get([attr]) or []
-                    if token == '...':
-                        # Only track recursion points in seen entities; all else statically terminates
-                        token = _base_pattern
-
-                    # * identity attr should key cardinality as well for reverse lookups; could have ref ident
-                    results = [self.pull(token, e,
-                                         # in case of recursive pulls
-                                         _base_pattern=(_base_pattern or pull_expr),
-                                         # Each of the pull results needs to know that the others
-                                         # will have been seed, as well as what has been seen.
-                                         # Note: doesn't look for relationships forked past
-                                         # that... Have to think about these side cases... update
-                                         # compute global state?
-                                         _seen_entities=_seen_entities)
-                               for e in (eids or [])]
-                    pull_data[attr] = results
-            for a, vs in pull_data.items():
-                pull_data[a] = some(vs) if self._card_one(a) else vs
-            return {k: some(v) if self._card_one(k) else v for k, v in pull_data.items()}
-            # ctn...
-
-    def pull_many(self, pull_expr, eids_or_pattern, sort_by=None, sort_desc=True):
+            eid = self._codes.lookup(entity.ident if isinstance(entity, Entity) else entity)
+        return self._pull(plan, eid, _seen_entities)
+
+    def _link(self, attr):
+        """How to get from an entity to the ones related to it through attr, as (how, attribute code), where how
+        is the index to look in, or None if there's no way to tell. Reverse lookups on lazy refs go through the
+        AVE index, which the attribute is added to if it isn't there already."""
+        descriptor = self._attr(attr)
+        if not descriptor.reverse:
+            return 'eav', self._codes.lookup(attr)
+        a = self._codes.lookup(descriptor.reverse)
+        if descriptor.ref:
+            # Can do this; have reverse mapping indexed (vae)
+            return 'vae', a
+        elif self.lazy_refs:
+            if not self._attr(descriptor.reverse).indexed:
+                # First time it's used as a ref; rather than search through all its triples every time, keep
+                # its values in the AVE index from now on
+                self._lazy_ref_attrs.add(descriptor.reverse)
+                self._invalidate_attr(descriptor.reverse)
+                self._reindex_values(descriptor.reverse)
+            return 'ave', a
+        warnings.warn("Warning! Should have either lazy refs or or a schema for reverse lookups!")
+        return None, a
+
+    def _step(self, link, eid):
+        """The encoded eids related to the encoded eid through a _link."""
+        how, a = link
+        if how == 'eav':
+            return self._eav_index.get([eid, a]) or ()
+        elif how == 'vae':
+            return self._vae_index.get([eid, a]) or ()
+        elif how == 'ave':
+            return self._ave_index.get([a, eid]) or ()
+        return ()
+
+    def _relink(self, attr, link):
+        # A link compiled before its attribute had a code may have one by now
+        how, a = link
+        return link if a is not None else (how, self._codes.lookup(self._attr(attr).reverse or attr))
+
+    def _neighbors(self, attr, eid):
+        """The encoded eids related to the encoded eid through attr, which may be a reverse (`ns:_attr`) lookup."""
+        return self._step(self._link(attr), eid)
+
+    def _closure(self, attrs, roots, memo=None):
+        """The encoded eids reachable from the (encoded) roots in one or more steps through any of attrs, which
+        may be reverse lookups. Evaluated semi-naively (each round only expands the eids first reached in the
+        round before). If given a memo dict, results are memoized in it per (attrs, roots); it's up to the
+        caller to keep that to a single query, since nothing clears it when the store changes. The returned set
+        may be shared; don't modify it."""
+        attrs, roots = tuple(attrs), frozenset(roots)
+        reached = memo.get((attrs, roots)) if memo is not None else None
+        if reached is None:
+            step = self._step
+            links = [self._link(attr) for attr in attrs]
+            reached = set()
+            delta = roots
+            while delta:
+                new = set()
+                for e in delta:
+                    for link in links:
+                        new.update(step(link, e))
+                delta = new - reached
+                reached |= delta
+            if memo is not None:
+                memo[(attrs, roots)] = reached
+        return reached
+
+    def _ident_stub(self, eid):
+        # What an already seen entity pulls as, where recursion is cut short
+        return {self.ident_attr: {self._codes.decode(eid)}}
+
+    def _pull(self, plan, eid, _seen_entities):
+        """As pull, for a compiled plan and an encoded eid. _seen_entities holds the eids pull is already
+        recursing through (via `'...'`), which pull as just their ident, so that cycles terminate."""
+        if eid in _seen_entities:
+            return self._ident_stub(eid)
+        memo = plan.memo
+        if memo is not None and not _seen_entities:
+            # Only with nothing seen; below a recursion point, the result can have stubs for the entities being
+            # recursed through, which a pull from elsewhere wouldn't
+            result = memo.get(eid)
+            if result is None:
+                if not memo:
+                    self._watch_pull_memo(plan)
+                result = memo[eid] = self._pull_entity(plan, eid, _seen_entities)
+            return result
+        if plan.recursive and plan is plan.base:
+            return self._pull_tree(plan, eid, _seen_entities)
+        return self._pull_entity(plan, eid, _seen_entities)
+
+    def _watch_pull_memo(self, plan):
+        # Have _attr_written clear the plan's memo if anything it depends on is written
+        self._pull_memos.add(plan)
+        if plan.deps is None:
+            self._watch_all = True
+        else:
+            self._watched.update(plan.deps)
+
+    def _pull_tree(self, plan, root, _seen_entities):
+        """Pull the recursive plan from root without actually recursing: the closure from root through its
+        `'...'` attrs gives every entity involved, each of which is pulled once, and then the results are linked
+        up depth first. Entities reached more than once share their result; ones closing a cycle pull as just
+        their ident."""
+        recursive = plan.recursive
+        nodes = set(self._closure([attr for attr, _, _, _ in recursive], [root]))
+        nodes.add(root)
+        nodes -= _seen_entities
+        data = {}
+        children = {}
+        for n in nodes:
+            data[n] = self._pull_entity(plan, n, _seen_entities, skip=True)
+            children[n] = [(attr, one, list(self._step(self._relink(attr, link), n)))
+                           for attr, link, _, one in recursive]
+        done = set()
+        on_path = set()
+        stack = [(root, False)]
+        while stack:
+            n, expanded = stack.pop()
+            if expanded:
+                on_path.discard(n)
+                done.add(n)
+                for attr, one, eids in children[n]:
+                    results = [data[e] if e in done else self._ident_stub(e) for e in eids]
+                    data[n][attr] = some(results) if one else results
+            elif n not in done and n not in on_path:
+                on_path.add(n)
+                stack.append((n, True))
+                stack.extend((e, False) for _, _, eids in children[n] for e in eids if e in nodes)
+        return data[root]
+
+    def _pull_entity(self, plan, eid, _seen_entities, skip=False):
+        """Pull everything in plan for eid, but for its `'...'` recursion points if skip."""
+        codes = self._codes
+        _entity = self._eav_index.get([eid]) or _SubIndex({})
+        pull_data = {}
+        for attr, a, one in plan.attrs:
+            if a is None:
+                # not seen yet when the plan was compiled
+                a = codes.lookup(attr)
+            vals = codes.decode_set(_entity.get([a]))
+            pull_data[attr] = some(vals) if one else vals
+        if plan.star:
+            star_attrs = plan.star_attrs
+            for a, vs in _entity.items():
+                entry = star_attrs.get(a)
+                if entry is None:
+                    attr = codes.decode(a)
+                    entry = star_attrs[a] = attr, self._attr(attr).card_one
+                attr, one = entry
+                if attr not in pull_data:
+                    vals = codes.decode_set(vs)
+                    pull_data[attr] = some(vals) if one else vals
+        # Deal with the dict patterns (and reverse lookups), which correspond with relations/refs (implicit are
+        # fine; though need to think about the details of how defaults and options work out)
+        for attr, link, sub, one in plan.links:
+            if link[1] is None:
+                link = self._relink(attr, link)
+            seen = _seen_entities
+            if sub is None:
+                if skip:
+                    continue
+                # A recursion point below the top level of the base pattern; recurse for real, tracking what
+                # we're recursing through
+                sub = plan.base
+                seen = _seen_entities | {eid}
+            results = [self._pull(sub, e, seen) for e in self._step(link, eid)]
+            pull_data[attr] = some(results) if one else results
+        return pull_data
+
+    def pull_many(self, pull_expr, eids_or_pattern, sort_by=None, sort_desc=True, workers=None, ordered=True,
+                  chunk_size=None):
+        """Pull pull_expr for each of eids_or_pattern (a list of eids or Entities, or a match pattern), lazily.
+
+        With workers > 1, the pulling is split over a pool of that many forked processes, which share the store
+        (copy-on-write) rather than getting a copy. Entities are handed out chunk_size at a time, and results
+        stream back in the order of the eids, or as they're done if not ordered."""
         # Could eventually first sort and take by some attribute without having to pull everything, if that
         # became necessary, using a first step to just pull that attribute, without the rest. Then do full
         # pull only for what's needed.
-        _seen_entities = set()
-        eids = self.match(eids_or_pattern) if isinstance(eids_or_pattern, dict) else eids_or_pattern
-        results = (self.pull(pull_expr, eid, _seen_entities=_seen_entities) for eid in eids)
+        plan = self.compile_pull(pull_expr)
+        if isinstance(eids_or_pattern, dict):
+            eids = self._match(eids_or_pattern)
+        else:
+            eids = [self._codes.lookup(eid.ident if isinstance(eid, Entity) else eid) for eid in eids_or_pattern]
+        if workers and workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            warnings.warn("Can't fork on this platform; pulling in a single process")
+            workers = None
+        if workers and workers > 1:
+            results = self._pull_parallel(plan, list(eids), workers, ordered, chunk_size)
+        else:
+            results = (self._pull(plan, eid, frozenset()) for eid in eids)
         if sort_by:
             results = sorted(results, key=lambda x: x[sort_by])
         if not sort_desc:
             results = reversed(results)
         return results
 
+    def _pull_parallel(self, plan, eids, workers, ordered, chunk_size):
+        global _pull_worker_plan
+        # a few chunks per worker, so they finish about together, but not so small the pickling dominates
+        chunk_size = chunk_size or max(1, min(1000, len(eids) // (4 * workers)))
+        chunks = [eids[i:i + chunk_size] for i in range(0, len(eids), chunk_size)]
+        _pull_worker_plan = plan
+        try:
+            pool = multiprocessing.get_context('fork').Pool(processes=workers)
+        finally:
+            _pull_worker_plan = None
+        try:
+            for results in (pool.imap if ordered else pool.imap_unordered)(_pull_chunk, chunks):
+                for result in results:
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+# Datalog queries
+# ---------------
+#
+# Everything here runs on codes. A where clause is joined against the rows so far (tuples of codes, with a
+# {var: position} slots map) in one of a few modes, chosen by the planner from what's already bound and the
+# index counts:
+#
+# * `e`: e is bound (or constant); look up its values in EAV for every row
+# * `v`: v is bound (or constant) and is a ref or db:index'd attribute; look up entities in VAE/AVE per row
+# * `scan`: hash join the rows against the attribute's full extent out of AEV
+# * `rule`: hash join the rows against a rule's materialized relation
+#
+# Joins are generators, so rows are pulled through the whole chain of them one at a time.
+
+
+def _is_var(x):
+    return isinstance(x, str) and x.startswith('?')
+
+
+class _TripleClause(object):
+    """A `[e, attr, v]` where clause, where e and v are variable names or encoded constants."""
+    __slots__ = ('attr', 'a', 'descriptor', 'e', 'v', 'empty')
+
+    def __init__(self, store, clause):
+        if len(clause) != 3:
+            raise ValueError("Where clauses should be [e, attr, v] triples or rule calls: {!r}".format(clause))
+        e, attr, v = clause
+        if not isinstance(attr, str) or _is_var(attr):
+            raise ValueError("Attributes in where clauses must be constants: {!r}".format(clause))
+        self.attr = attr
+        self.descriptor = store._attr(attr)
+        self.a = store._codes.lookup(attr)
+        # an unknown attribute or constant can't match anything
+        self.empty = self.a is None
+        self.e, self.v = [self._term(store, x) for x in (e, v)]
+
+    def _term(self, store, x):
+        if _is_var(x):
+            return x
+        code = store._codes.lookup(x)
+        if code is None:
+            self.empty = True
+        return code
+
+    def plan(self, store, bound, n, relations):
+        """Return (cost, estimated rows after, mode) for joining this clause onto ~n rows binding bound."""
+        if self.empty:
+            return 0, 0, 'empty'
+        e, v = self.e, self.v
+        if not _is_var(e) or e in bound:
+            return n, n, 'e'
+        descriptor = self.descriptor
+        if (not _is_var(v) or v in bound) and (descriptor.ref or descriptor.indexed):
+            if _is_var(v):
+                return n, n, 'v'
+            index, key = (store._vae_index, [v, self.a]) if descriptor.ref else (store._ave_index, [self.a, v])
+            fanout = index.count(key)
+            return n * fanout, n * fanout, 'v'
+        size = store._aev_index.count([self.a])
+        if _is_var(v) and v in bound:
+            return size + n, n, 'scan'
+        return size + n * size, n * size, 'scan'
+
+    def join(self, rows, slots, mode, store, relations):
+        e, v = self.e, self.v
+        e_slot = slots.get(e) if _is_var(e) else None
+        v_slot = slots.get(v) if _is_var(v) else None
+        new_e = _is_var(e) and e_slot is None
+        new_v = _is_var(v) and v_slot is None and v != e
+        for var, new in ((e, new_e), (v, new_v)):
+            if new:
+                slots[var] = len(slots)
+        if mode == 'empty':
+            return iter(())
+        elif mode == 'e':
+            return self._join_e(rows, e_slot, v_slot, new_v, store)
+        elif mode == 'v':
+            return self._join_v(rows, v_slot, store)
+        return self._join_scan(rows, v_slot, new_v, store)
+
+    def _join_e(self, rows, e_slot, v_slot, new_v, store):
+        get = store._eav_index.get
+        e, v, a = self.e, self.v, self.a
+        for row in rows:
+            vals = get([row[e_slot] if e_slot is not None else e, a])
+            if not vals:
+                continue
+            if new_v:
+                for x in vals:
+                    yield row + (x,)
+            elif (row[v_slot] if v_slot is not None else v) in vals:
+                yield row
+
+    def _join_v(self, rows, v_slot, store):
+        a, v = self.a, self.v
+        if self.descriptor.ref:
+            get = store._vae_index.get
+            def lookup(x):
+                return get([x, a])
+        else:
+            get = store._ave_index.get
+            def lookup(x):
+                return get([a, x])
+        for row in rows:
+            for x in lookup(row[v_slot] if v_slot is not None else v) or ():
+                yield row + (x,)
+
+    def _join_scan(self, rows, v_slot, new_v, store):
+        pairs = store._aev_index.get([self.a]) or ()
+        v = self.v
+        if v_slot is not None:
+            # v bound, but not indexed; hash the extent by value
+            table = collections.defaultdict(list)
+            for x, y in pairs:
+                table[y].append(x)
+            for row in rows:
+                for x in table.get(row[v_slot], ()):
+                    yield row + (x,)
+            return
+        if not new_v:
+            # constant v (or ?x attr ?x)
+            extent = [(x,) for x, y in pairs if (y == v if not _is_var(v) else x == y)]
+        else:
+            extent = list(pairs)
+        for row in rows:
+            for ext in extent:
+                yield row + ext
+
+
+def _reverse_attr(attr):
+    namespace, _, name = attr.rpartition(':')
+    return namespace + ':_' + name if namespace else '_' + name
+
+
+class _RuleClause(object):
+    """A `[rule_name, arg, ...]` where clause, joined against the rule's relation. key is the rule name, or
+    (name, 'delta') for a clause reading only the last round's new tuples during semi-naive evaluation."""
+    __slots__ = ('name', 'key', 'args', 'empty')
+
+    def __init__(self, store, clause):
+        self.name = self.key = clause[0]
+        self.empty = False
+        self.args = []
+        for x in clause[1:]:
+            if _is_var(x):
+                self.args.append(x)
+            else:
+                code = store._codes.lookup(x)
+                self.empty = self.empty or code is None
+                self.args.append(code)
+
+    def delta(self):
+        clause = copy.copy(self)
+        clause.key = (self.name, 'delta')
+        return clause
+
+    def _closure_step(self, store, bound, relations):
+        """For a closure rule with a bound end, (attr to step through, from arg, to arg); otherwise None."""
+        attr = relations.closures.get(self.key)
+        if attr is None or len(self.args) != 2:
+            return None
+        x, y = self.args
+        if not _is_var(x) or x in bound:
+            return attr, 0, 1
+        if (not _is_var(y) or y in bound) and (store._attr(attr).ref or store.lazy_refs):
+            return _reverse_attr(attr), 1, 0
+        return None
+
+    def plan(self, store, bound, n, relations):
+        if self.empty:
+            return 0, 0, 'empty'
+        elif self._closure_step(store, bound, relations):
+            return n, n, 'closure'
+        if self.key in relations.closures and self.key not in relations:
+            # don't materialize a closure rule just to size it up
+            size = store._aev_index.count([store._codes.lookup(relations.closures[self.key])])
+        else:
+            size = len(relations[self.key])
+        if any(not _is_var(x) or x in bound for x in self.args):
+            return size + n, n, 'rule'
+        return size + n * size, n * size, 'rule'
+
+    def join(self, rows, slots, mode, store, relations):
+        if mode == 'closure':
+            attr, src, dst = self._closure_step(store, slots, relations)
+            src, dst = self.args[src], self.args[dst]
+            src_slot = slots.get(src) if _is_var(src) else None
+            dst_slot = slots.get(dst) if _is_var(dst) else None
+            new_dst = _is_var(dst) and dst_slot is None
+            if new_dst:
+                slots[dst] = len(slots)
+            return self._join_closure(rows, store, relations, attr, src, src_slot, dst, dst_slot, new_dst)
+        # positions of the relation we key on (constants and bound vars), and of the vars it binds
+        key_pos, key_terms, new_pos, checks = [], [], [], []
+        first = {}
+        for i, x in enumerate(self.args):
+            if not _is_var(x) or x in slots:
+                key_pos.append(i)
+                key_terms.append(x)
+            elif x in first:
+                # repeated new variable
+                checks.append((first[x], i))
+            else:
+                first[x] = i
+                new_pos.append(i)
+                slots[x] = len(slots)
+        if mode == 'empty':
+            return iter(())
+        return self._join(rows, slots, relations[self.key], key_pos, key_terms, new_pos, checks)
+
+    def _join_closure(self, rows, store, relations, attr, src, src_slot, dst, dst_slot, new_dst):
+        closure, memo = store._closure, relations.reached
+        for row in rows:
+            reached = closure((attr,), (row[src_slot] if src_slot is not None else src,), memo)
+            if new_dst:
+                for x in reached:
+                    yield row + (x,)
+            elif (row[dst_slot] if dst_slot is not None else dst) in reached:
+                yield row
+
+    def _join(self, rows, slots, relation, key_pos, key_terms, new_pos, checks):
+        table = collections.defaultdict(list)
+        for t in list(relation):
+            if all(t[i] == t[j] for i, j in checks):
+                table[tuple(t[i] for i in key_pos)].append(tuple(t[i] for i in new_pos))
+        key_slots = [(slots[x], None) if _is_var(x) else (None, x) for x in key_terms]
+        for row in rows:
+            key = tuple(row[slot] if slot is not None else x for slot, x in key_slots)
+            for ext in table.get(key, ()):
+                yield row + ext
+
+
+class _Relations(dict):
+    """Rule relations (sets of code tuples) by rule name, or by (name, 'delta') for the tuples added in the
+    last round of semi-naive evaluation. Rules which are just the closure of an attribute are kept in closures
+    (name: attr) and evaluated with TripleStore._closure from whichever end is bound; they only get
+    materialized here if some clause needs them whole. reached memoizes the closures joined against, for the
+    length of the query."""
+
+    def __init__(self, store, names):
+        dict.__init__(self)
+        self.store = store
+        self.names = names
+        self.closures = {}
+        self.reached = {}
+
+    def __missing__(self, key):
+        attr = self.closures[key]
+        store = self.store
+        extent = store._aev_index.get([store._codes.lookup(attr)])
+        relation = self[key] = set((x, z) for x in (extent.iterkeys() if extent else ())
+                                   for z in store._closure((attr,), (x,)))
+        return relation
+
+
+def _closure_rule(name, definitions):
+    """If the (head vars, body) definitions of a rule are just the transitive closure of an attribute, as in
+
+        [[name, '?x', '?y'], ['?x', attr, '?y']]
+        [[name, '?x', '?z'], ['?x', attr, '?y'], [name, '?y', '?z']]
+
+    (or with the recursive body the other way round), return the attribute."""
+    if len(definitions) != 2:
+        return None
+    base = [d for d in definitions if len(d[1]) == 1]
+    recursive = [d for d in definitions if len(d[1]) == 2]
+    if len(base) != 1 or len(recursive) != 1:
+        return None
+    (head, [clause]), (rec_head, body) = base[0], recursive[0]
+    if len(head) != 2 or len(rec_head) != 2 or len(clause) != 3 or any(len(c) != 3 for c in body):
+        return None
+    attr = clause[1]
+    if list(head) != [clause[0], clause[2]] or not isinstance(attr, str) or _is_var(attr):
+        return None
+    x, z = rec_head
+    for step, call in (body, body[::-1]):
+        # right recursive: [x attr y] [name y z]; left recursive: [name x y] [y attr z]
+        y = step[2] if step[0] == x else step[0]
+        if (step[1] == attr and call[0] == name and all(_is_var(t) for t in (x, y, z)) and len({x, y, z}) == 3 and
+                ((step[0] == x and list(call[1:]) == [y, z]) or (step[2] == z and list(call[1:]) == [x, y]))):
+            return attr
+    return None
+
+
+def _where_clauses(store, where, rule_names):
+    return [_RuleClause(store, clause) if clause and clause[0] in rule_names and not _is_var(clause[0])
+            else _TripleClause(store, clause)
+            for clause in where]
+
+
+def _run_where(store, clauses, relations):
+    """Plan and join the clauses, returning (rows, slots), where rows is a generator."""
+    slots = {}
+    rows = iter([()])
+    n = 1
+    remaining = list(clauses)
+    while remaining:
+        plans = [clause.plan(store, slots, n, relations) for clause in remaining]
+        i = min(range(len(plans)), key=lambda i: plans[i][0])
+        _, n, mode = plans[i]
+        rows = remaining.pop(i).join(rows, slots, mode, store, relations)
+    return rows, slots
+
+
+def _project(rows, slots, variables):
+    try:
+        positions = [slots[x] for x in variables]
+    except KeyError as e:
+        raise ValueError("Variable {} isn't bound by any where clause".format(e.args[0]))
+    for row in rows:
+        yield tuple(row[i] for i in positions)
+
+
+def _distinct(rows):
+    seen = set()
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+def _eval_rules(store, rules):
+    """Evaluate the rules into a _Relations. Closure rules are left to TripleStore._closure; the rest are
+    materialized semi-naively: after one pass over the non-recursive bodies, each round joins every recursive
+    body once per rule call in it, with that call reading only the tuples the round before added, until a round
+    adds nothing."""
+    definitions = collections.defaultdict(list)
+    for rule in rules:
+        head, body = rule[0], rule[1:]
+        definitions[head[0]].append((head[1:], body))
+    relations = _Relations(store, set(definitions))
+    for name, defs in definitions.items():
+        attr = _closure_rule(name, defs)
+        if attr:
+            relations.closures[name] = attr
+    materialized = [name for name in definitions if name not in relations.closures]
+    base, recursive = [], []
+    for name in materialized:
+        relations[name] = set()
+        for head_vars, body in definitions[name]:
+            clauses = _where_clauses(store, body, relations.names)
+            calls = [i for i, c in enumerate(clauses) if isinstance(c, _RuleClause) and c.name in materialized]
+            if not calls:
+                base.append((name, head_vars, clauses))
+            for i in calls:
+                variant = list(clauses)
+                variant[i] = clauses[i].delta()
+                recursive.append((name, head_vars, variant))
+
+    def derive(bodies):
+        new = {name: set() for name in materialized}
+        for name, head_vars, clauses in bodies:
+            relation, added = relations[name], new[name]
+            rows, slots = _run_where(store, clauses, relations)
+            for row in _project(rows, slots, head_vars):
+                if row not in relation:
+                    added.add(row)
+        for name, added in new.items():
+            relations[name] |= added
+            relations[(name, 'delta')] = added
+        return any(new.values())
+
+    if derive(base):
+        while derive(recursive):
+            pass
+    return relations
+
+
+def _run_query(store, query):
+    find = query['find']
+    relations = _eval_rules(store, query['rules']) if query.get('rules') else _Relations(store, set())
+    rows, slots = _run_where(store, _where_clauses(store, query['where'], relations.names), relations)
+    decode = store._codes.decode
+    results = (tuple(decode(x) for x in row) for row in _distinct(_project(rows, slots, find)))
+    take, sort = query.get('take'), query.get('sort')
+    if sort:
+        sort = [sort] if isinstance(sort, str) else sort
+        positions = [find.index(x) for x in sort]
+
+        def key(row):
+            return tuple(row[i] for i in positions)
+
+        desc = query.get('sort_desc', False)
+        if take is not None:
+            return (heapq.nlargest if desc else heapq.nsmallest)(take, results, key=key)
+        return sorted(results, key=key, reverse=desc)
+    elif take is not None:
+        return list(itertools.islice(results, take))
+    return list(results)
+
+
+def _load_shard(args):
+    """Worker for parallel TripleStore.loads: index one file in a store of its own, and hand back its code table
+    and AEV index for merging. Snapshots already are one, so are just read."""
+    cls, filename, schema, id_attrs, default_cardinality, lazy_refs, stream = args
+    with open(filename, 'rb') as fp:
+        if is_snapshot(fp):
+            _, state = _read_snapshot(fp)
+            return state['codes'], state['aev']
+        data = iter_json_facts(fp) if stream else json.load(fp)
+        store = cls(facts=data, schema=schema, id_attrs=id_attrs, default_cardinality=default_cardinality,
+                    lazy_refs=lazy_refs)
+    return store._codes.values, store._aev_index.keys
+
+
+# The plan (and so store) the workers of a parallel pull_many pull from. Set just while the pool forks, so that
+# the workers inherit it, and never have to be sent the store.
+_pull_worker_plan = None
+
+
+def _pull_chunk(eids):
+    """Worker for parallel TripleStore.pull_many: pull a chunk of (encoded) eids."""
+    plan = _pull_worker_plan
+    return [plan.store._pull(plan, eid, frozenset()) for eid in eids]
+
 
 # Our data constructors, as pure functions
 